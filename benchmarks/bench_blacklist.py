@@ -0,0 +1,72 @@
+"""Aho-Corasick blacklist matching against the old any(word in content) scan
+
+    python benchmarks/bench_blacklist.py --sizes 100,1000,10000 --scans 200
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from events.blacklist import BlacklistMatcher
+
+
+def random_terms(rng: random.Random, count: int) -> set:
+    terms = set()
+    while len(terms) < count:
+        terms.add(''.join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 10))))
+    return terms
+
+
+def random_message(rng: random.Random, length: int, terms: set) -> str:
+    # Plain words, none of them blacklisted, so both sides scan the whole message (the common case)
+    words = []
+    while sum(len(word) + 1 for word in words) < length:
+        words.append(''.join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 8))))
+    message = ' '.join(words)[:length]
+    while any(term in message for term in terms):
+        message = message.replace(next(term for term in terms if term in message), 'x')
+    return message
+
+
+def timed(func, scans: int) -> float:
+    started = time.perf_counter()
+    for _ in range(scans):
+        func()
+    return (time.perf_counter() - started) * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='100,1000,10000', help="Comma separated blacklist sizes")
+    parser.add_argument('--scans', type=int, default=200, help="Messages scanned per size")
+    parser.add_argument('--length', type=int, default=500, help="Characters per message")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{args.scans} scans of a {args.length} character message without a match")
+    print(f"{'terms':>8} {'build ms':>10} {'aho-corasick ms':>16} {'any(word in) ms':>16} {'speedup':>8}")
+    for size in (int(size) for size in args.sizes.split(',')):
+        terms = random_terms(rng, size)
+        message = random_message(rng, args.length, terms)
+        hit = message[:40] + ' ' + next(iter(terms))
+
+        started = time.perf_counter()
+        matcher = BlacklistMatcher(terms)
+        build_ms = (time.perf_counter() - started) * 1000
+
+        # Both sides must agree before their timings mean anything
+        assert matcher.find(message) is None and not any(word in message for word in terms)
+        assert matcher.find(hit) is not None and any(word in hit for word in terms)
+
+        automaton_ms = timed(lambda: matcher.find(message), args.scans)
+        linear_ms = timed(lambda: any(word in message for word in terms), args.scans)
+        print(f"{size:>8} {build_ms:>10.1f} {automaton_ms:>16.1f} {linear_ms:>16.1f} {linear_ms / automaton_ms:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
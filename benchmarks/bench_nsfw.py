@@ -0,0 +1,94 @@
+"""Images per second through NSFWDetector's process pool, end to end and for inference alone
+
+    python benchmarks/bench_nsfw.py --images 200 --workers 4 --batch-size 8 --concurrency 32
+"""
+import argparse
+import asyncio
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw
+
+from events.nsfw import NSFWDetector
+
+WARMUP_SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'assets', 'nsfw_warmup.png')
+
+
+def synthetic_jpeg(seed: int, width: int, height: int) -> bytes:
+    """A distinct photo-sized JPEG per seed, so no two images share a perceptual hash"""
+    rng = random.Random(seed)
+    image = Image.new('RGB', (width, height), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x, y = rng.randrange(width), rng.randrange(height)
+        box = (x, y, x + rng.randrange(20, width // 3), y + rng.randrange(20, height // 3))
+        fill = tuple(rng.randrange(256) for _ in range(3))
+        (draw.ellipse if rng.random() < 0.5 else draw.rectangle)(box, fill=fill)
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+async def run_bounded(items, func, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(item):
+        async with semaphore:
+            await func(item)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(item) for item in items))
+    return time.perf_counter() - started
+
+
+async def bench(args) -> None:
+    width, height = (int(side) for side in args.size.split('x'))
+    images = [synthetic_jpeg(seed, width, height) for seed in range(args.images)]
+    print(f"{len(images)} {width}x{height} JPEGs, {sum(map(len, images)) / len(images) / 1024:.0f} KiB on average")
+
+    detector = NSFWDetector(
+        workers=args.workers,
+        batch_size=args.batch_size,
+        batch_wait=args.batch_wait_ms / 1000,
+        cache_size=0
+    )
+    try:
+        await detector.warm_up(WARMUP_SAMPLE)
+        print(f"{detector.workers} workers, model load {detector.startup.get('model_load_ms', 0):.0f}ms, "
+              f"warm-up inference {detector.startup.get('warm_up_ms', 0):.0f}ms")
+
+        # End to end: Pillow preprocessing and hashing, then batched inference in the pool
+        elapsed = await run_bounded(images, detector.classify, args.concurrency)
+        print(f"classify:  {len(images) / elapsed:6.1f} images/sec ({elapsed * 1000 / len(images):.1f}ms each)")
+
+        # Inference alone, on thumbnails prepared up front
+        loop = asyncio.get_running_loop()
+        prepared = [await loop.run_in_executor(None, detector.preprocessor.prepare, data) for data in images]
+        elapsed = await run_bounded([p.thumbnail for p in prepared], detector.batcher.submit, args.concurrency)
+        print(f"inference: {len(images) / elapsed:6.1f} images/sec ({elapsed * 1000 / len(images):.1f}ms each)")
+
+        stats = detector.batcher.stats()
+        print(f"batches {stats['batches']}, average size {stats['avg_batch_size']:.1f}, "
+              f"average queue wait {stats['avg_queue_wait_ms']:.1f}ms")
+    finally:
+        await detector.cleanup()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', type=int, default=200)
+    parser.add_argument('--size', default='1280x720', help="WIDTHxHEIGHT of the generated images")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes, one per core by default")
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--batch-wait-ms', type=float, default=5)
+    parser.add_argument('--concurrency', type=int, default=32, help="Images in flight at once")
+    asyncio.run(bench(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,11 @@ import discord
 from discord.ext import commands
 from discord import app_commands
 from typing import Optional, List, Dict, Any
-from pymongo import MongoClient
 import os
 from datetime import datetime
 from dotenv import load_dotenv
+from events.database import Database
+from events.bans import BanIndex
 
 load_dotenv()
 
@@ -15,30 +16,28 @@ class BeaniverseBanSystem(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
 
-        mongodb_uri = os.getenv('MONGODB_URI')
-        if not mongodb_uri:
-            raise ValueError("MONGODB_URI not found in environment variables")
-
-        self.client = MongoClient(mongodb_uri, serverSelectionTimeoutMS=5000)
-        self.db = self.client['global_chat']
+        self.db: Database = bot.database
         self.bans = self.db['bans']
+        self.index = BanIndex(self.bans, poll_interval=float(os.getenv('BAN_SYNC_INTERVAL', '30')))
+
+    async def cog_load(self) -> None:
+        await self.setup_indexes()
+        await self.index.load()
+        self.index.start()
 
-        self.setup_indexes()
+    async def cog_unload(self) -> None:
+        await self.index.stop()
 
-    def setup_indexes(self) -> None:
+    async def setup_indexes(self) -> None:
         try:
-            self.bans.create_index("user_id")
-            self.bans.create_index("server_id")
+            await self.bans.create_index("user_id")
+            await self.bans.create_index("server_id")
             print("Ban system indexes created successfully!")
         except Exception as e:
             print(f"Error creating ban system indexes: {e}")
 
     def is_banned(self, user_id: Optional[int] = None, server_id: Optional[int] = None) -> bool:
-        if user_id:
-            return bool(self.bans.find_one({"user_id": user_id, "active": True}))
-        if server_id:
-            return bool(self.bans.find_one({"server_id": server_id, "active": True}))
-        return False
+        return self.index.is_banned(user_id=user_id, server_id=server_id)
 
     async def check_permissions(self, interaction: discord.Interaction) -> bool:
         if interaction.user.id not in AUTHORIZED_USERS:
@@ -75,7 +74,7 @@ class BeaniverseBanSystem(commands.Cog):
                 inline=False
             )
         
-        registered_channels = self.db['servers'].find()
+        registered_channels = await self.db['servers'].find()
         for channel_data in registered_channels:
             channel_id = channel_data.get('channel_id')
             channel = self.bot.get_channel(channel_id)
@@ -124,6 +123,10 @@ class BeaniverseBanSystem(commands.Cog):
                     await button_interaction.response.send_message("You cannot use these buttons.", ephemeral=True)
                     return
 
+                if self.is_banned(user_id=user.id):
+                    await button_interaction.response.edit_message(content=f"{user.mention} is already banned.", view=None)
+                    return
+
                 db_ban_data = {
                     "user_id": user.id,
                     "user_name": str(user),
@@ -133,7 +136,8 @@ class BeaniverseBanSystem(commands.Cog):
                     "active": True
                 }
 
-                self.bans.insert_one(db_ban_data)
+                result = await self.bans.insert_one(db_ban_data)
+                self.index.apply({**db_ban_data, '_id': result.inserted_id})
                 
                 embed = discord.Embed(
                     title="Message Not Sent",
@@ -186,11 +190,13 @@ class BeaniverseBanSystem(commands.Cog):
         if not await self.check_permissions(interaction):
             return
 
-        banned_users = list(self.bans.find({"active": True}))
+        banned_users = await self.bans.find({"active": True})
         if not banned_users:
             await interaction.response.send_message("There are no banned users.", ephemeral=True)
             return
 
+        # Older data can hold several active documents for one user, the menu needs each user once
+        banned_users = list({user_data["user_id"]: user_data for user_data in banned_users}.values())
         select_menu = BannedUserSelect(banned_users)
         
         view = discord.ui.View(timeout=60)
@@ -215,10 +221,12 @@ class BeaniverseBanSystem(commands.Cog):
                     await button_interaction.response.send_message("You cannot use these buttons.", ephemeral=True)
                     return
 
-                self.bans.update_one(
+                # Every active document, a user banned twice must not stay banned in the database
+                await self.bans.update_many(
                     {"user_id": user.id, "active": True},
                     {"$set": {"active": False, "unbanned_by": select_interaction.user.id, "unban_time": datetime.utcnow()}}
                 )
+                self.index.remove(user_id=user.id)
 
                 embed = discord.Embed(
                     title="Beaniverse Unban",
@@ -263,8 +271,50 @@ class BeaniverseBanSystem(commands.Cog):
         select_menu.callback = select_callback
         await interaction.response.send_message("Select a user to unban:", view=view, ephemeral=True)
 
-    async def cog_unload(self) -> None:
-        self.client.close()
+    @app_commands.command(name="unmute", description="**Authorized user only.** Lift a user's mute in Beaniverse.")
+    @app_commands.describe(user="The muted user")
+    async def unmute(self, interaction: discord.Interaction, user: discord.User):
+        if not await self.check_permissions(interaction):
+            return
+
+        handler = self.bot.get_cog('GlobalChatHandler')
+        if not handler:
+            await interaction.response.send_message("Chat handler is currently unavailable.", ephemeral=True)
+            return
+
+        entry = await handler.unmute_user(user, interaction.user)
+        if entry is None:
+            await interaction.response.send_message(f"{user.mention} is not muted.", ephemeral=True)
+            return
+
+        await interaction.response.send_message(
+            f"Unmuted {user.mention}, who was muted for: {entry.reason}",
+            ephemeral=True
+        )
+
+    @app_commands.command(name="forgethash", description="**Authorized user only.** Clear a stored NSFW image hash flagged in error.")
+    @app_commands.describe(image_hash="The ref shown when a message was turned away, e.g. 0f3c...")
+    async def forgethash(self, interaction: discord.Interaction, image_hash: str):
+        if not await self.check_permissions(interaction):
+            return
+
+        handler = self.bot.get_cog('GlobalChatHandler')
+        if not handler:
+            await interaction.response.send_message("Chat handler is currently unavailable.", ephemeral=True)
+            return
+
+        await interaction.response.defer(ephemeral=True)
+        try:
+            forgotten = await handler.nsfw_detector.forget_hash(image_hash.strip(), interaction.user.id)
+        except Exception as e:
+            print(f"Error clearing NSFW hash {image_hash}: {e}")
+            await interaction.followup.send(f"An error occurred: {str(e)}", ephemeral=True)
+            return
+
+        if forgotten:
+            await interaction.followup.send(f"Cleared NSFW hash `{image_hash}`, matching images are no longer turned away.", ephemeral=True)
+        else:
+            await interaction.followup.send(f"No stored NSFW hash `{image_hash}` was found.", ephemeral=True)
 
 async def setup(bot: commands.Bot):
     await bot.add_cog(BeaniverseBanSystem(bot))
@@ -1,9 +1,10 @@
 import discord
-from discord.ext import commands
-from pymongo import MongoClient
+from discord.ext import commands, tasks
 import os
-from typing import Optional, Dict, Set, Tuple, List, Union
+import json
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
 import aiofiles
+import aiofiles.os
 import asyncio
 import time
 from datetime import datetime, timezone, timedelta
@@ -11,8 +12,26 @@ from dotenv import load_dotenv
 import logging
 from logging.handlers import RotatingFileHandler
 from discord import TextChannel
-import re
-from events.nsfw import NSFWDetector
+from events.nsfw import NSFWDetector, ScanResult
+from events.moderation_worker import RemoteNSFWDetector
+from events.fanout import FanoutEngine, FanoutStats
+from events.delivery import DeliveryManager, Envelope, RelayLedger
+from events.attachments import TMPFS_DIR, AttachmentBundle, AttachmentFetcher
+from events.webhooks import WebhookRegistry
+from events.database import Database
+from events.message_log import MessageLogBuffer
+from events.blacklist import BlacklistMatcher
+from events.moderation import (
+    COST_CHEAP,
+    COST_EXPENSIVE,
+    COST_MODERATE,
+    COST_TRIVIAL,
+    REJECT_SILENTLY,
+    ContentScanner,
+    ModerationPipeline
+)
+from events.ratelimit import SpamLimiter
+from events.mutes import MuteEntry, MuteScheduler, MuteStore
 
 load_dotenv()
 
@@ -46,6 +65,7 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 BLACKLIST_PATH = os.path.join(BASE_DIR, 'blacklist.txt')
+NSFW_WARMUP_SAMPLE = os.path.join(BASE_DIR, 'assets', 'nsfw_warmup.png')
 
 
 class MuteExpiredView(discord.ui.View):
@@ -68,165 +88,252 @@ class GlobalChatHandler(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
 
-        mongodb_uri = os.getenv('MONGODB_URI')
-        if not mongodb_uri:
-            logger.error("MONGODB_URI not found in environment variables.")
-            raise ValueError("MONGODB_URI not found in environment variables")
-
         self.SPAM_COOLDOWN = 2
         self.SPAM_THRESHOLD = 8
         self.SPAM_TIME_WINDOW = 1
         self.BLACKLIST_COOLDOWN = 60
         self.MAX_MESSAGE_LENGTH = 2000
         self.MAX_ATTACHMENTS = 10
-        self.MUTE_CHECK_INTERVAL = 5
+        self.BLACKLIST_RELOAD_INTERVAL = float(os.getenv('BLACKLIST_RELOAD_INTERVAL', '5'))
         self.WEBHOOK_NAME = 'beaniverse'
+        self.WEBHOOK_POOL_SIZE = int(os.getenv('WEBHOOK_POOL_SIZE', '3'))
+        self.WEBHOOK_RATE_LIMIT = 5
+        self.WEBHOOK_RATE_WINDOW = 2
+        self.FANOUT_CONCURRENCY = int(os.getenv('FANOUT_CONCURRENCY', '50'))
+        self.FANOUT_TIMEOUT = float(os.getenv('FANOUT_TIMEOUT', '10'))
+        self.ATTACHMENT_SPOOL_THRESHOLD = int(os.getenv('ATTACHMENT_SPOOL_THRESHOLD', str(8 * 1024 * 1024)))
+        self.ATTACHMENT_DOWNLOAD_TIMEOUT = float(os.getenv('ATTACHMENT_DOWNLOAD_TIMEOUT', '60'))
+        self.ATTACHMENT_SPOOL_DIR = os.getenv('ATTACHMENT_SPOOL_DIR') or TMPFS_DIR
+        # Relay text right away and scan attachments alongside, retracting the copies if the scan flags them
+        self.OPTIMISTIC_RELAY = os.getenv('OPTIMISTIC_RELAY', 'false').lower() in ('1', 'true', 'yes')
+        # local scans in this process's worker pool, remote hands them to supervised moderation worker processes
+        self.MODERATION_BACKEND = os.getenv('MODERATION_BACKEND', 'local').lower()
+        # Seconds between stats log lines, 0 turns them off
+        self.STATS_LOG_INTERVAL = float(os.getenv('STATS_LOG_INTERVAL', '300'))
+
+        self.db: Database = bot.database
+        self.servers = self.db['servers']
+        self.users = self.db['users']
+        self.message_logs = self.db['message_logs']
+        self.message_log = MessageLogBuffer(
+            self.message_logs,
+            batch_size=int(os.getenv('MESSAGE_LOG_BATCH_SIZE', '500')),
+            flush_interval=float(os.getenv('MESSAGE_LOG_FLUSH_INTERVAL', '2')),
+            max_buffered=int(os.getenv('MESSAGE_LOG_MAX_BUFFERED', '10000'))
+        )
 
-        self.DISCORD_INVITE_PATTERN = re.compile(
-            r'(?:https?://)?(?:www\.)?((?:discord\.(?:gg|io|me|li|com)|discordapp\.com)/(?:invite/)?[a-zA-Z0-9-]+)',
-            re.IGNORECASE
+        self.webhook_registry = WebhookRegistry(
+            self.bot,
+            self.servers,
+            self.WEBHOOK_NAME,
+            pool_size=self.WEBHOOK_POOL_SIZE,
+            rate_limit=self.WEBHOOK_RATE_LIMIT,
+            rate_window=self.WEBHOOK_RATE_WINDOW
         )
-        
-        self.ADULT_CONTENT_PATTERN = re.compile(
-            r'(?:https?://)?(?:www\.)?'
-            r'(?:'
-            r'(?:[a-zA-Z0-9\-]+\.)*(?:porn|pinayflix|jakol|hubad|iyot|kayat|kantot|xxx|sex|adult|nsfw|hentai|xvideos|pornhub|xnxx|xhamster|redtube|youporn)'
-            r'(?:\.[a-zA-Z]{2,})\b'
-            r'|'
-            r'(?:only\.)?fans/|onlyfans\.com'
-            r')',
-            re.IGNORECASE
+        self.spam_limiter = SpamLimiter(self.SPAM_THRESHOLD, self.SPAM_TIME_WINDOW, self.SPAM_COOLDOWN)
+        self.mute_store = MuteStore(
+            self.db['mutes'],
+            flush_interval=float(os.getenv('MUTE_FLUSH_INTERVAL', '1'))
         )
-        
-        try:
-            self.client = MongoClient(mongodb_uri, serverSelectionTimeoutMS=5000)
-            self.client.server_info()
-            self.db = self.client['global_chat']
-            self.servers = self.db['servers']
-            self.users = self.db['users']
-            self.message_logs = self.db['message_logs']
-            logger.info("Connected to MongoDB successfully.")
-        except Exception as e:
-            logger.error(f"Failed to connect to MongoDB: {e}")
-            raise
-
-        self.webhooks: Dict[int, discord.Webhook] = {}
-        self.user_message_count: Dict[int, List[float]] = {}
-        self.muted_users: Dict[int, Tuple[datetime, str, Optional[discord.Message], int]] = {}
-        self.blacklisted_words: Set[str] = set()
+        self.mutes = MuteScheduler(self.on_mute_expired, self.mute_store)
+        self.blacklist = BlacklistMatcher(())
+        self.scanner = ContentScanner()
+        self.moderation = ModerationPipeline(os.getenv('MODERATION_DISABLED_STAGES', '').split(','))
+        self.register_moderation_stages()
+        self.blacklist_mtime: Optional[int] = None
         self.registered_channels: Set[int] = set()
-        self.nsfw_detector = NSFWDetector()
-
-        self.setup_indexes()
+        self.nsfw_detector: Union[NSFWDetector, RemoteNSFWDetector]
+        if self.MODERATION_BACKEND == 'remote':
+            self.nsfw_detector = RemoteNSFWDetector.from_env()
+        else:
+            self.nsfw_detector = NSFWDetector.from_env(self.db['nsfw_hashes'])
+        self.nsfw_warm_up: Optional[asyncio.Task] = None
+        self.attachment_fetcher = AttachmentFetcher(
+            self.ATTACHMENT_SPOOL_THRESHOLD,
+            download_timeout=self.ATTACHMENT_DOWNLOAD_TIMEOUT,
+            spool_dir=self.ATTACHMENT_SPOOL_DIR
+        )
+        # One download per message, started by the NSFW scan and handed to the relay
+        self.attachment_fetches: Dict[int, asyncio.Task] = {}
+        self.fanout = FanoutEngine(self.FANOUT_CONCURRENCY, self.FANOUT_TIMEOUT)
+        self.delivery = DeliveryManager(self.fanout, self.send_to_channel, self.MAX_MESSAGE_LENGTH)
 
-        self.bot.loop.create_task(self._load_blacklist())
         self.bot.loop.create_task(self.load_registered_channels())
-        self.monitor_task = self.bot.loop.create_task(self.monitor_mutes())
 
         self.reports = self.db['reports']
         self.reports_counter = self.db['reports_counter']
-        
-        self.setup_report_indexes()
 
-    def setup_indexes(self) -> None:
+    async def cog_load(self) -> None:
+        await self.setup_indexes()
+        await self.setup_report_indexes()
+        self.message_log.start()
+        self.spam_limiter.start()
+        await self._restore_mutes()
+        await self._load_nsfw_hashes()
+        self.nsfw_warm_up = asyncio.create_task(self._warm_up_nsfw())
+        self.mute_store.start()
+        self.mutes.start()
+
+        await self._load_blacklist()
+        self.watch_blacklist.change_interval(seconds=self.BLACKLIST_RELOAD_INTERVAL)
+        self.watch_blacklist.start()
+
+        if self.STATS_LOG_INTERVAL > 0:
+            self.log_stats.change_interval(seconds=self.STATS_LOG_INTERVAL)
+            self.log_stats.start()
+
+    async def setup_indexes(self) -> None:
         try:
-            self.users.create_index([("user_id", 1)], unique=True)
-            self.servers.create_index([("channel_id", 1)], unique=True)
-            self.message_logs.create_index([("timestamp", 1)])
-            self.message_logs.create_index([("user_id", 1)])
+            await self.users.create_index([("user_id", 1)], unique=True)
+            await self.servers.create_index([("channel_id", 1)], unique=True)
+            await self.message_logs.create_index([("timestamp", 1)])
+            await self.message_logs.create_index([("user_id", 1)])
+            await self.mute_store.setup_indexes()
+            await self.nsfw_detector.setup_indexes()
             logger.info("MongoDB indexes created successfully!")
         except Exception as e:
             logger.error(f"Error creating MongoDB indexes: {e}")
 
-    def setup_report_indexes(self) -> None:
+    async def _restore_mutes(self) -> None:
+        try:
+            restored = self.mutes.restore(await self.mute_store.load())
+            logger.info(f"Restored {restored} active mutes.")
+        except Exception as e:
+            logger.error(f"Error restoring mutes: {e}")
+
+    async def _load_nsfw_hashes(self) -> None:
+        try:
+            loaded = await self.nsfw_detector.load_hashes()
+            logger.info(f"Loaded {loaded} known NSFW image hashes.")
+        except Exception as e:
+            logger.error(f"Error loading NSFW image hashes: {e}")
+
+    async def _warm_up_nsfw(self) -> None:
+        # After login, so loading the model never competes with connecting and syncing commands
+        await self.bot.wait_until_ready()
+        await self.nsfw_detector.warm_up(NSFW_WARMUP_SAMPLE)
+
+    async def setup_report_indexes(self) -> None:
         try:
-            self.reports.create_index("report_number")
-            self.reports.create_index("reported_user_id")
-            self.reports.create_index("reporter_id")
-            self.reports.create_index("timestamp")
+            await self.reports.create_index("report_number")
+            await self.reports.create_index("reported_user_id")
+            await self.reports.create_index("reporter_id")
+            await self.reports.create_index("timestamp")
             logger.info("Report system indexes created successfully!")
         except Exception as e:
             logger.error(f"Error creating report system indexes: {e}")
 
     async def _load_blacklist(self) -> None:
         try:
+            self.blacklist_mtime = (await aiofiles.os.stat(BLACKLIST_PATH)).st_mtime_ns
             async with aiofiles.open(BLACKLIST_PATH, mode='r', encoding='utf-8') as f:
                 content = await f.read()
-                self.blacklisted_words = set(
-                    word.strip().lower()
-                    for word in content.split('\n')
-                    if word.strip() and not word.startswith('#')
-                )
-            logger.info(f"Loaded {len(self.blacklisted_words)} blacklisted words.")
+            terms = {
+                self.scanner.normalize(word.strip())
+                for word in content.split('\n')
+                if word.strip() and not word.startswith('#')
+            }
+            if terms == self.blacklist.terms:
+                return
+
+            # Building the automaton is CPU bound, the old matcher keeps serving until the swap
+            matcher = await asyncio.get_running_loop().run_in_executor(None, BlacklistMatcher, terms)
+            previous, self.blacklist = self.blacklist, matcher
+            self._log_blacklist_diff(previous, matcher)
         except FileNotFoundError:
             logger.warning("blacklist.txt not found. Creating an empty file.")
             try:
                 async with aiofiles.open(BLACKLIST_PATH, mode='w', encoding='utf-8') as f:
                     await f.write("# Add blacklisted words here, one per line\n")
-                self.blacklisted_words = set()
                 logger.info("Created empty blacklist.txt.")
             except PermissionError as pe:
                 logger.error(f"Permission denied while creating blacklist.txt: {pe}")
-                self.blacklisted_words = set()
             except Exception as e:
                 logger.error(f"Error creating blacklist.txt: {e}")
-                self.blacklisted_words = set()
         except PermissionError as pe:
             logger.error(f"Permission denied while accessing blacklist.txt: {pe}")
-            self.blacklisted_words = set()
         except Exception as e:
             logger.error(f"Error loading blacklist: {e}")
-            self.blacklisted_words = set()
+
+    def _log_blacklist_diff(self, previous: BlacklistMatcher, current: BlacklistMatcher) -> None:
+        added = sorted(current.terms - previous.terms)
+        removed = sorted(previous.terms - current.terms)
+        logger.info(
+            f"Loaded {len(current)} blacklisted words "
+            f"(+{len(added)}: {', '.join(added[:20]) or '-'}{' ...' if len(added) > 20 else ''}; "
+            f"-{len(removed)}: {', '.join(removed[:20]) or '-'}{' ...' if len(removed) > 20 else ''})."
+        )
+
+    @tasks.loop(seconds=5)
+    async def watch_blacklist(self) -> None:
+        try:
+            mtime = (await aiofiles.os.stat(BLACKLIST_PATH)).st_mtime_ns
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error(f"Error checking blacklist.txt for changes: {e}")
+            return
+
+        if mtime != self.blacklist_mtime:
+            await self._load_blacklist()
+
+    async def collect_stats(self) -> Dict[str, Any]:
+        return {
+            'delivery': self.delivery.summary(),
+            'message_log': self.message_log.stats(),
+            'spam_limiter': self.spam_limiter.stats(),
+            'moderation': self.moderation.stats(),
+            'nsfw': await self.nsfw_detector.collect_stats()
+        }
+
+    @tasks.loop(seconds=300)
+    async def log_stats(self) -> None:
+        try:
+            stats = await self.collect_stats()
+        except Exception as e:
+            logger.error(f"Error collecting stats: {e}")
+            return
+
+        for section, values in stats.items():
+            logger.info(f"Stats {section}: {json.dumps(values, default=str)}")
 
     async def load_registered_channels(self) -> None:
         try:
-            servers = self.servers.find({}, {'channel_id': 1})
+            servers = await self.servers.find({}, {'channel_id': 1, 'webhook': 1, 'webhooks': 1})
             self.registered_channels = {int(server['channel_id']) for server in servers if 'channel_id' in server}
-            logger.info(f"Loaded {len(self.registered_channels)} registered channels.")
+            stored_webhooks = sum(self.webhook_registry.load(server) for server in servers)
+            logger.info(
+                f"Loaded {len(self.registered_channels)} registered channels "
+                f"and {stored_webhooks} stored webhooks."
+            )
         except Exception as e:
             logger.error(f"Error loading registered channels: {e}")
             self.registered_channels = set()
+            return
+
+        await self.webhook_registry.warm_up(self.registered_channels)
 
     def is_channel_registered(self, channel_id: int) -> bool:
         return channel_id in self.registered_channels
 
-    def contains_blacklisted_words(self, content: str) -> bool:
-        return any(word in content.lower() for word in self.blacklisted_words)
-
     def is_user_muted(self, user_id: int) -> Tuple[bool, Optional[str], Optional[discord.Message], Optional[int]]:
-        if user_id in self.muted_users:
-            mute_end_time, reason, mute_message, channel_id = self.muted_users[user_id]
-            if datetime.now(timezone.utc) < mute_end_time:
-                return True, reason, mute_message, channel_id
-            else:
-                del self.muted_users[user_id]
+        entry = self.mutes.get(user_id)
+        if entry:
+            return True, entry.reason, entry.mute_message, entry.channel_id
         return False, None, None, None
 
     async def get_or_create_webhook(self, channel: TextChannel) -> Optional[discord.Webhook]:
-        try:
-            if channel.id in self.webhooks:
-                return self.webhooks[channel.id]
+        return await self.webhook_registry.acquire(channel)
 
-            webhooks = await channel.webhooks()
-            webhook = discord.utils.get(webhooks, name=self.WEBHOOK_NAME)
-
-            if webhook is None:
-                webhook = await channel.create_webhook(name=self.WEBHOOK_NAME)
-                logger.info(f"Created new webhook for channel {channel.id}.")
-
-            self.webhooks[channel.id] = webhook
-            return webhook
-        except discord.Forbidden:
-            logger.error(f"Missing permissions to manage webhooks in channel {channel.id}.")
-            return None
-        except Exception as e:
-            logger.error(f"Error getting or creating webhook in channel {channel.id}: {e}")
-            return None
+    async def mute_user(self, user: Union[discord.User, discord.Member], duration: Optional[int], reason: str, channel: TextChannel) -> None:
+        """Mute a user for duration seconds, or permanently when duration is None"""
+        existing = self.mutes.get(user.id)
+        if existing and existing.permanent:
+            # A cooldown for a later rejected message must not shorten a permanent mute
+            duration = None
 
-    async def mute_user(self, user: Union[discord.User, discord.Member], duration: int, reason: str, channel: TextChannel) -> None:
         current_time = datetime.now(timezone.utc)
-        end_time = current_time + timedelta(seconds=duration)
-        formatted_time = discord.utils.format_dt(end_time, style='R')
+        end_time = current_time + timedelta(seconds=duration) if duration is not None else None
 
         embed = discord.Embed(
             title="You have been muted",
@@ -235,16 +342,17 @@ class GlobalChatHandler(commands.Cog):
         )
         embed.add_field(
             name="Duration",
-            value=f"until in {duration} seconds"
+            value=f"until in {duration} seconds" if duration is not None else "permanent"
         )
 
         logger.info(
-            f"Muted user {user.id} until {end_time.strftime('%Y-%m-%d %H:%M:%S')} "
+            f"Muted user {user.id} "
+            f"{'until ' + end_time.strftime('%Y-%m-%d %H:%M:%S') if end_time else 'permanently'} "
             f"for reason: {reason}"
         )
 
         try:
-            self.users.update_one(
+            await self.users.update_one(
                 {'user_id': user.id},
                 {
                     '$push': {
@@ -294,7 +402,7 @@ class GlobalChatHandler(commands.Cog):
                 logger.error(f"Error sending mute message to user {user.id}: {e}")
                 mute_message = None
 
-        self.muted_users[user.id] = (end_time, reason, mute_message, channel.id)
+        self.mutes.schedule(user.id, end_time, reason, mute_message, channel.id)
 
         try:
             await channel.send(f"{user.mention}, you are currently muted. Wait for the cooldown.", delete_after=5)
@@ -302,112 +410,169 @@ class GlobalChatHandler(commands.Cog):
         except Exception as e:
             logger.error(f"Failed to send mute notification in channel {channel.id}: {e}")
 
-        async def unmute_task():
-            await asyncio.sleep(duration)
-            unmute_embed = discord.Embed(
+    async def unmute_user(self, user: Union[discord.User, discord.Member], unmuted_by: Union[discord.User, discord.Member]) -> Optional[MuteEntry]:
+        """Lift a user's mute early, permanent ones included, returns the lifted mute or None if there was none"""
+        entry = self.mutes.cancel(user.id)
+        if entry is None:
+            return None
+
+        logger.info(f"User {user.id} unmuted by {unmuted_by.id}, was muted for: {entry.reason}")
+        # Notified in the background, the command has to answer its interaction within 3 seconds
+        asyncio.create_task(self.on_mute_expired(entry))
+        return entry
+
+    async def on_mute_expired(self, entry: MuteEntry) -> None:
+        user = self.bot.get_user(entry.user_id)
+        if not user:
+            return
+
+        try:
+            embed = discord.Embed(
                 title="Mute Expired",
                 description="You can now send messages again.",
                 color=discord.Color.green(),
                 timestamp=datetime.now(timezone.utc)
             )
-            view = MuteExpiredView(channel.id)
-            await user.send(embed=unmute_embed, view=view)
-        
-        self.bot.loop.create_task(unmute_task())
-
-    async def monitor_mutes(self) -> None:
-        while not self.bot.is_closed():
-            current_time = datetime.now(timezone.utc)
-            expired_mutes = [
-                user_id
-                for user_id, (end_time, _, _, _) in self.muted_users.items()
-                if current_time >= end_time
-            ]
-
-            for user_id in expired_mutes:
-                _, _, mute_message, channel_id = self.muted_users.pop(user_id)
-                user = self.bot.get_user(user_id)
-                if user:
-                    try:
-                        embed = discord.Embed(
-                            title="Mute Expired",
-                            description="You can now send messages again.",
-                            color=discord.Color.green(),
-                            timestamp=current_time
-                        )
-                        view = MuteExpiredView(channel_id)
-                        await user.send(embed=embed, view=view)
-                        logger.info(f"Sent mute expired notification to user {user_id}.")
-
-                        if mute_message:
-                            try:
-                                await mute_message.delete()
-                                logger.info(f"Deleted mute message for user {user_id}.")
-                            except Exception as e:
-                                logger.error(f"Failed to delete mute message for user {user_id}: {e}")
-                    except discord.Forbidden:
-                        logger.warning(f"Failed to send mute expired notification to user {user_id}.")
-                    except Exception as e:
-                        logger.error(f"Error handling mute expiration for user {user_id}: {e}")
-
-            await asyncio.sleep(self.MUTE_CHECK_INTERVAL)
-
-    async def validate_message(self, message: discord.Message) -> Tuple[bool, Optional[str]]:
-        if not self.is_channel_registered(message.channel.id):
-            return False, None
+            view = MuteExpiredView(entry.channel_id)
+            await user.send(embed=embed, view=view)
+            logger.info(f"Sent mute expired notification to user {entry.user_id}.")
 
-        is_muted, reason, _, _ = self.is_user_muted(message.author.id)
-        if is_muted:
-            return False, reason
+            if entry.mute_message:
+                try:
+                    await entry.mute_message.delete()
+                    logger.info(f"Deleted mute message for user {entry.user_id}.")
+                except Exception as e:
+                    logger.error(f"Failed to delete mute message for user {entry.user_id}: {e}")
+        except discord.Forbidden:
+            logger.warning(f"Failed to send mute expired notification to user {entry.user_id}.")
+        except Exception as e:
+            logger.error(f"Error handling mute expiration for user {entry.user_id}: {e}")
+
+    def register_moderation_stages(self) -> None:
+        self.moderation.register('registered', COST_TRIVIAL, self._check_registered, required=True)
+        self.moderation.register('muted', COST_TRIVIAL, self._check_muted)
+        self.moderation.register('length', COST_TRIVIAL, self._check_length)
+        self.moderation.register('attachment_count', COST_TRIVIAL, self._check_attachment_count)
+        self.moderation.register('spam', COST_CHEAP, self._check_spam)
+        self.moderation.register('content', COST_MODERATE, self._check_content)
+        self.moderation.register('nsfw', COST_EXPENSIVE, self._check_nsfw)
 
-        if self.DISCORD_INVITE_PATTERN.search(message.content):
-            return False, "Discord invites are not allowed"
+    async def _check_registered(self, message: discord.Message) -> Optional[str]:
+        return None if self.is_channel_registered(message.channel.id) else REJECT_SILENTLY
 
-        if self.ADULT_CONTENT_PATTERN.search(message.content):
-            return False, "Adult content links are not allowed"
+    async def _check_muted(self, message: discord.Message) -> Optional[str]:
+        is_muted, reason, _, _ = self.is_user_muted(message.author.id)
+        return (reason or REJECT_SILENTLY) if is_muted else None
 
+    async def _check_length(self, message: discord.Message) -> Optional[str]:
         if len(message.content) > self.MAX_MESSAGE_LENGTH:
-            return False, "Message exceeds maximum length"
+            return "Message exceeds maximum length"
+        return None
 
+    async def _check_attachment_count(self, message: discord.Message) -> Optional[str]:
         if len(message.attachments) > self.MAX_ATTACHMENTS:
-            return False, "Too many attachments"
-
-        if self.contains_blacklisted_words(message.content):
-            return False, "Message contains prohibited words"
-
-        user_id = message.author.id
-        current_time = time.time()
-
-        if user_id not in self.user_message_count:
-            self.user_message_count[user_id] = []
+            return "Too many attachments"
+        return None
+
+    async def _check_spam(self, message: discord.Message) -> Optional[str]:
+        return self.spam_limiter.check(message.author.id)
+
+    async def _check_content(self, message: discord.Message) -> Optional[str]:
+        violation = self.scanner.scan(message.content, self.blacklist)
+        if violation:
+            rule, reason = violation
+            logger.info(f"Message from user {message.author.id} rejected by {rule} rule: {reason}")
+            return reason
+        return None
+
+    async def _check_nsfw(self, message: discord.Message) -> Optional[str]:
+        if not message.attachments:
+            return None
 
-        self.user_message_count[user_id].append(current_time)
-        self.user_message_count[user_id] = [
-            t for t in self.user_message_count[user_id]
-            if current_time - t <= self.SPAM_TIME_WINDOW
-        ]
+        result = await self.scan_attachments(message)
+        if result.known_hash:
+            # A stored hash only turns the message away, a permanent mute needs a fresh verdict from the model
+            return self.known_nsfw_reason(result)
+        if result.is_nsfw:
+            await self.punish_nsfw(message, result.score, result.content_type)
+            return "NSFW content detected"
+        return None
+
+    @staticmethod
+    def known_nsfw_reason(result: ScanResult) -> str:
+        return f"Image matches known NSFW content (ref {result.known_hash})"
+
+    async def punish_nsfw(self, message: discord.Message, score: float, content_type: str) -> None:
+        if isinstance(message.channel, TextChannel):
+            await self.mute_user(
+                message.author,
+                None,
+                f"NSFW {content_type} detected (Score: {score:.2f})",
+                message.channel
+            )
 
-        if len(self.user_message_count[user_id]) > self.SPAM_THRESHOLD:
-            return False, "Too many messages sent in a short time"
-
-        if len(self.user_message_count[user_id]) > 1:
-            time_diff = current_time - self.user_message_count[user_id][-2]
-            if time_diff < self.SPAM_COOLDOWN:
-                return False, "Message sent too quickly"
-
-        if message.attachments:
-            is_nsfw, score, content_type = await self.nsfw_detector.check_message(message)
-            if is_nsfw:
-                if isinstance(message.channel, TextChannel):
-                    await self.mute_user(
-                        message.author,
-                        float('inf'),
-                        f"NSFW {content_type} detected (Score: {score:.2f})",
-                        message.channel
-                    )
-                return False, f"NSFW content detected"
+    def fetch_attachments(self, message: discord.Message) -> asyncio.Task:
+        """The message's one download, shared by the NSFW scan and the relay"""
+        fetch = self.attachment_fetches.get(message.id)
+        if fetch is None:
+            # Images and videos too large to scan are neither downloaded nor relayed
+            limit = self.nsfw_detector.download_limit if 'nsfw' in self.moderation else None
+            fetch = asyncio.create_task(self.attachment_fetcher.fetch(message.attachments, limit))
+            self.attachment_fetches[message.id] = fetch
+        return fetch
+
+    async def take_attachments(self, message: discord.Message) -> AttachmentBundle:
+        """Hand the scanned download to the relay, which closes it once delivered"""
+        attachments = await self.fetch_attachments(message)
+        await self.attachment_fetcher.shrink(attachments, self.nsfw_detector.preprocessor.shrink_for_forwarding)
+        self.attachment_fetches.pop(message.id, None)
+        return attachments
+
+    def release_attachments(self, message_id: int) -> None:
+        """Close a download the relay did not take, cancelling it if it is still running"""
+        fetch = self.attachment_fetches.pop(message_id, None)
+        if fetch is not None:
+            fetch.add_done_callback(self._close_fetched)
+            fetch.cancel()
+
+    @staticmethod
+    def _close_fetched(fetch: asyncio.Task) -> None:
+        if not fetch.cancelled() and fetch.exception() is None:
+            fetch.result().close()
+
+    async def scan_attachments(self, message: discord.Message) -> ScanResult:
+        """Scan the message's download, leaving out of it whatever could not be scanned"""
+        attachments = await self.fetch_attachments(message)
+        result = await self.nsfw_detector.check_message(message, attachments)
+        if result.unscanned and not result.is_nsfw:
+            dropped = attachments.drop(result.unscanned)
+            logger.warning(f"Not relaying {', '.join(dropped)} from message {message.id}, it could not be scanned.")
+        return result
+
+    async def validate_message(self, message: discord.Message, skip: Tuple[str, ...] = ()) -> Tuple[bool, Optional[str]]:
+        reason = await self.moderation.run(message, skip)
+        if reason is None:
+            return True, None
+        return False, reason or None
+
+    async def reject_message(self, message: discord.Message, reason: str) -> None:
+        cooldown_duration = self.SPAM_COOLDOWN if "quickly" in reason else self.BLACKLIST_COOLDOWN
+
+        if isinstance(message.channel, TextChannel):
+            await self.mute_user(
+                message.author,
+                cooldown_duration,
+                reason,
+                message.channel
+            )
+        else:
+            logger.warning(f"Attempted to mute user in a non-TextChannel: {message.channel}")
 
-        return True, None
+        try:
+            await message.delete()
+            logger.info(f"Deleted invalid message from user {message.author.id} in channel {message.channel.id}.")
+        except Exception as e:
+            logger.error(f"Failed to delete message from user {message.author.id}: {e}")
 
     async def forward_message(self, message: discord.Message) -> None:
         if message.author.bot:
@@ -416,7 +581,7 @@ class GlobalChatHandler(commands.Cog):
         if not self.is_channel_registered(message.channel.id):
             return
 
-        ban_system = self.bot.get_cog('GlobalBanSystem')
+        ban_system = self.bot.get_cog('BeaniverseBanSystem')
         if ban_system and ban_system.is_banned(user_id=message.author.id):
             try:
                 await message.delete()
@@ -452,104 +617,198 @@ class GlobalChatHandler(commands.Cog):
                 logger.error(f"Error handling banned user message: {e}")
             return
 
-        is_valid, error_reason = await self.validate_message(message)
+        optimistic = self.OPTIMISTIC_RELAY and bool(message.attachments) and 'nsfw' in self.moderation
+        is_valid, error_reason = await self.validate_message(message, ('nsfw',) if optimistic else ())
         if not is_valid:
             if error_reason:
-                cooldown_duration = self.SPAM_COOLDOWN if "quickly" in error_reason else self.BLACKLIST_COOLDOWN
-
-                if isinstance(message.channel, TextChannel):
-                    await self.mute_user(
-                        message.author,
-                        cooldown_duration,
-                        error_reason,
-                        message.channel
-                    )
-                else:
-                    logger.warning(f"Attempted to mute user in a non-TextChannel: {message.channel}")
+                await self.reject_message(message, error_reason)
+            return
 
-                try:
-                    await message.delete()
-                    logger.info(f"Deleted invalid message from user {message.author.id} in channel {message.channel.id}.")
-                except Exception as e:
-                    logger.error(f"Failed to delete message from user {message.author.id}: {e}")
+        self.message_log.add({
+            'user_id': message.author.id,
+            'channel_id': message.channel.id,
+            'content': message.content,
+            'timestamp': datetime.now(timezone.utc),
+            'attachment_count': len(message.attachments)
+        })
+
+        targets = [
+            target_channel_id
+            for target_channel_id in self.registered_channels
+            if target_channel_id != message.channel.id
+        ]
+
+        server_name = message.guild.name if message.guild else "Direct Message"
+        username = f"{message.author.display_name} | {server_name}"
+
+        if optimistic:
+            await self.relay_optimistically(message, targets, username)
             return
 
+        attachments = await self.take_attachments(message)
+        if message.attachments and not attachments.attachments and not message.content:
+            logger.info(f"Nothing left to relay from message {message.id}.")
+            return
+
+        stats = FanoutStats(message.id, len(targets))
+
+        for target_channel_id in targets:
+            self.delivery.enqueue(target_channel_id, Envelope(
+                [message.id],
+                message.author.id,
+                username,
+                message.author.display_avatar.url,
+                message.content or "",
+                attachments,
+                [stats]
+            ))
+
+        try:
+            await stats.wait()
+            logger.info(f"Fan-out for message {message.id}: {stats.summary()}")
+        finally:
+            attachments.close()
+
+    async def relay_optimistically(self, message: discord.Message, targets: List[int], username: str) -> None:
+        """Relay the text now and the attachments once scanned, retracting the text if the scan flags them"""
+        ledger = RelayLedger(message.id)
+        scan = asyncio.create_task(self.scan_attachments(message))
+
+        text_stats = None
+        if message.content:
+            text_stats = FanoutStats(message.id, len(targets))
+            for target_channel_id in targets:
+                self.delivery.enqueue(target_channel_id, Envelope(
+                    [message.id],
+                    message.author.id,
+                    username,
+                    message.author.display_avatar.url,
+                    message.content,
+                    None,
+                    [text_stats],
+                    ledger
+                ))
+
         try:
-            self.message_logs.insert_one({
-                'user_id': message.author.id,
-                'channel_id': message.channel.id,
-                'content': message.content,
-                'timestamp': datetime.now(timezone.utc),
-                'attachment_count': len(message.attachments)
-            })
-            logger.info(f"Logged message from user {message.author.id} in channel {message.channel.id}.")
+            result = await scan
         except Exception as e:
-            logger.error(f"Failed to log message from user {message.author.id}: {e}")
+            # Nothing unscanned is relayed, on_message closes the download
+            logger.error(f"Error scanning attachments of message {message.id}, not relaying them: {e}")
+            result = None
+
+        if result is not None and result.is_nsfw:
+            retracted = await ledger.retract(self.fanout)
+            logger.info(f"Retracted {retracted} relayed copies of NSFW message {message.id}.")
+            if result.known_hash:
+                await self.reject_message(message, self.known_nsfw_reason(result))
+                return
+
+            await self.punish_nsfw(message, result.score, result.content_type)
+            try:
+                await message.delete()
+            except Exception as e:
+                logger.error(f"Failed to delete message from user {message.author.id}: {e}")
+            return
+
+        attachments = await self.take_attachments(message) if result is not None else AttachmentBundle([])
+        stats = FanoutStats(message.id, len(targets) if attachments.attachments else 0)
+        for target_channel_id in targets if attachments.attachments else ():
+            self.delivery.enqueue(target_channel_id, Envelope(
+                [message.id],
+                message.author.id,
+                username,
+                message.author.display_avatar.url,
+                "",
+                attachments,
+                [stats]
+            ))
+
+        try:
+            await stats.wait()
+            if text_stats:
+                await text_stats.wait()
+                logger.info(f"Fan-out for message {message.id} text: {text_stats.summary()}")
+            logger.info(f"Fan-out for message {message.id} attachments: {stats.summary()}")
+        finally:
+            attachments.close()
+
+    async def send_to_channel(self, target_channel_id: int, envelope: Envelope) -> bool:
+        channel = self.bot.get_channel(target_channel_id)
+        if not channel:
+            logger.warning(f"Target channel {target_channel_id} not found.")
+            return False
 
-        for target_channel_id in self.registered_channels:
-            if target_channel_id == message.channel.id:
-                continue
+        if not isinstance(channel, TextChannel):
+            logger.warning(f"Target channel {target_channel_id} is not a TextChannel.")
+            return False
 
-            channel = self.bot.get_channel(target_channel_id)
-            if not channel:
-                logger.warning(f"Target channel {target_channel_id} not found.")
-                continue
+        if envelope.ledger and envelope.ledger.retracted:
+            return False
 
-            if not isinstance(channel, TextChannel):
-                logger.warning(f"Target channel {target_channel_id} is not a TextChannel.")
-                continue
+        try:
+            send_kwargs = dict(
+                username=envelope.username,
+                avatar_url=envelope.avatar_url,
+                content=envelope.content,
+                allowed_mentions=discord.AllowedMentions(
+                    everyone=False,
+                    roles=False,
+                    users=True
+                )
+            )
 
-            try:
+            for _ in range(2):
                 webhook = await self.get_or_create_webhook(channel)
-                if webhook:
-                    server_name = message.guild.name if message.guild else "Direct Message"
-                    username = f"{message.author.display_name} | {server_name}"
-
-                    files = []
-                    for attachment in message.attachments:
-                        try:
-                            file = await attachment.to_file()
-                            if file:
-                                files.append(file)
-                        except Exception as e:
-                            logger.error(f"Failed to process attachment from user {message.author.id}: {e}")
-
-                    if not files:
-                        files = []
-
-                    logger.debug(f"Preparing to send message to webhook in channel {target_channel_id} with {len(files)} files.")
-
-                    await webhook.send(
-                        username=username,
-                        avatar_url=message.author.display_avatar.url,
-                        content=message.content or "",
-                        files=files,
-                        allowed_mentions=discord.AllowedMentions(
-                            everyone=False,
-                            roles=False,
-                            users=True
-                        )
-                    )
-                    logger.info(f"Forwarded message to channel {target_channel_id}.")
-            except Exception as e:
-                logger.error(f"Failed to forward message to channel {target_channel_id}: {e}")
+                if not webhook:
+                    return False
+
+                files = envelope.attachments.to_files() if envelope.attachments else []
+                logger.debug(f"Preparing to send message to webhook in channel {target_channel_id} with {len(files)} files.")
+
+                try:
+                    sent = await webhook.send(files=files, wait=envelope.ledger is not None, **send_kwargs)
+                    if envelope.ledger and sent:
+                        envelope.ledger.record(target_channel_id, webhook, sent.id)
+                    break
+                except discord.NotFound:
+                    logger.warning(f"Webhook {webhook.id} for channel {target_channel_id} was deleted.")
+                    await self.webhook_registry.invalidate(target_channel_id, webhook.id)
+                except discord.HTTPException as e:
+                    if e.status != 429:
+                        raise
+                    logger.warning(f"Webhook {webhook.id} for channel {target_channel_id} is rate limited.")
+                    self.webhook_registry.record_rate_limit(target_channel_id, webhook.id, self.WEBHOOK_RATE_WINDOW)
+            else:
+                return False
+
+            logger.info(f"Forwarded message to channel {target_channel_id}.")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to forward message to channel {target_channel_id}: {e}")
+            return False
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message) -> None:
-        await self.forward_message(message)
+        try:
+            await self.forward_message(message)
+        finally:
+            # A download the relay did not take, because the message was turned away or failed
+            self.release_attachments(message.id)
 
     async def cleanup(self) -> None:
-        self.monitor_task.cancel()
-        try:
-            await self.monitor_task
-        except asyncio.CancelledError:
-            logger.info("Monitor task cancelled successfully.")
-        try:
-            self.client.close()
-            logger.info("MongoDB connection closed.")
-        except Exception as e:
-            logger.error(f"Error closing MongoDB connection: {e}")
-        self.nsfw_detector.cleanup()
+        self.watch_blacklist.cancel()
+        self.log_stats.cancel()
+        if self.nsfw_warm_up and not self.nsfw_warm_up.done():
+            self.nsfw_warm_up.cancel()
+        await self.mutes.stop()
+        await self.mute_store.close()
+        await self.delivery.close()
+        for message_id in list(self.attachment_fetches):
+            self.release_attachments(message_id)
+        await self.attachment_fetcher.close()
+        await self.message_log.close()
+        await self.spam_limiter.stop()
+        await self.nsfw_detector.cleanup()
 
     async def cog_unload(self) -> None:
         await self.cleanup()
@@ -557,7 +816,7 @@ class GlobalChatHandler(commands.Cog):
 
     async def store_report(self, report_data: dict) -> bool:
         try:
-            self.reports.insert_one(report_data)
+            await self.reports.insert_one(report_data)
             return True
         except Exception as e:
             logger.error(f"Error storing report: {e}")
@@ -565,7 +824,7 @@ class GlobalChatHandler(commands.Cog):
 
     async def get_next_report_number(self) -> int:
         try:
-            result = self.reports_counter.find_one_and_update(
+            result = await self.reports_counter.find_one_and_update(
                 {'_id': 'report_count'},
                 {'$inc': {'count': 1}},
                 upsert=True,
@@ -1,15 +1,12 @@
 import discord
 from discord import app_commands
 from discord.ext import commands
-from pymongo import MongoClient
-import os
+from events.database import Database
 
 class GlobalChat(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        mongodb_uri = os.getenv('MONGODB_URI')
-        self.client = MongoClient(mongodb_uri)
-        self.db = self.client['global_chat']
+        self.db: Database = bot.database
         self.servers = self.db['servers']
 
     @app_commands.command(name="joinbeaniverse", description="**Admin permission required.** Add this server to the Beaniverse network.")
@@ -22,7 +19,7 @@ class GlobalChat(commands.Cog):
         try:
             invite = await channel.create_invite(max_age=0, max_uses=0)
 
-            existing_server = self.servers.find_one({"guild_id": interaction.guild_id})
+            existing_server = await self.servers.find_one({"guild_id": interaction.guild_id})
             if existing_server:
                 await interaction.response.send_message("❌ This server is already connected to the Beaniverse network!", ephemeral=True)
                 return
@@ -36,7 +33,7 @@ class GlobalChat(commands.Cog):
                 "added_at": discord.utils.utcnow().isoformat()
             }
 
-            self.servers.insert_one(server_data)
+            await self.servers.insert_one(server_data)
 
             embed = discord.Embed(
                 title="🌐 Beaniverse Connected!",
@@ -73,7 +70,7 @@ class GlobalChat(commands.Cog):
             return
 
         try:
-            result = self.servers.find_one_and_delete({"guild_id": interaction.guild_id})
+            result = await self.servers.find_one_and_delete({"guild_id": interaction.guild_id})
 
             if not result:
                 await interaction.response.send_message("❌ This server is not connected to the Beaniverse network!", ephemeral=True)
@@ -161,14 +161,14 @@ class ListCommands(commands.Cog):
                 return
 
             if category == "servers":
-                servers = list(handler.servers.find({}))
+                servers = await handler.servers.find({})
                 if not servers:
                     await interaction.response.send_message("No servers are currently connected.", ephemeral=True)
                     return
                 pages = self.create_server_pages(servers)
 
             elif category == "users":
-                banned_users = list(handler.users.find({"mute_history": {"$exists": True}}))
+                banned_users = await handler.users.find({"mute_history": {"$exists": True}})
                 if not banned_users:
                     await interaction.response.send_message("No users have been muted.", ephemeral=True)
                     return
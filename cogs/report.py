@@ -25,7 +25,7 @@ class BanButton(discord.ui.View):
             return
 
         try:
-            ban_system = interaction.client.get_cog('GlobalBanSystem')
+            ban_system = interaction.client.get_cog('BeaniverseBanSystem')
             if not ban_system:
                 await interaction.response.send_message("Ban system is currently unavailable.", ephemeral=True)
                 return
@@ -35,6 +35,10 @@ class BanButton(discord.ui.View):
                 await interaction.response.send_message("Could not find user to ban.", ephemeral=True)
                 return
 
+            if ban_system.is_banned(user_id=user.id):
+                await interaction.response.send_message(f"{user.mention} is already banned.", ephemeral=True)
+                return
+
             confirm = discord.ui.Button(label="Confirm", style=discord.ButtonStyle.success)
             cancel = discord.ui.Button(label="Cancel", style=discord.ButtonStyle.secondary)
             view = discord.ui.View(timeout=60)
@@ -47,6 +51,10 @@ class BanButton(discord.ui.View):
                     return
 
                 try:
+                    if ban_system.is_banned(user_id=user.id):
+                        await button_interaction.response.edit_message(content=f"{user.mention} is already banned.", view=None)
+                        return
+
                     db_ban_data = {
                         "user_id": user.id,
                         "user_name": str(user),
@@ -56,7 +64,8 @@ class BanButton(discord.ui.View):
                         "active": True
                     }
 
-                    ban_system.bans.insert_one(db_ban_data)
+                    result = await ban_system.bans.insert_one(db_ban_data)
+                    ban_system.index.apply({**db_ban_data, '_id': result.inserted_id})
 
                     embed = discord.Embed(
                         title="You have been banned from Beaniverse",
@@ -70,7 +79,7 @@ class BanButton(discord.ui.View):
                     except:
                         pass
 
-                    await ban_system.announce_to_registered_channels(f"User {user.mention} has been banned from Beaniverse.")
+                    await ban_system.announce_to_registered_channels(user, "Banned from report", interaction.user, "banned")
 
                     button.disabled = True
                     await interaction.message.edit(view=self)
@@ -224,7 +233,7 @@ class ReportSystem(commands.Cog):
                 return
 
         self.report_cooldowns[user_id] = now
-        await interaction.response.send_modal(ReportModal())
+        await interaction.response.send_modal(ReportModal(self.bot))
 
 async def setup(bot: commands.Bot):
     await bot.add_cog(ReportSystem(bot))
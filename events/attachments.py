@@ -0,0 +1,221 @@
+import asyncio
+import io
+import logging
+import os
+import shutil
+import tempfile
+from typing import Callable, Collection, List, Optional, Sequence, Tuple, Union
+
+import aiofiles
+import aiohttp
+import discord
+
+logger = logging.getLogger(__name__)
+
+# tmpfs when the host has one. Spooled attachments are read back for the scan and for every upload,
+# so they stay in RAM rather than making a round trip through disk. OpenCV also needs a path for video.
+TMPFS_DIR = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else None
+
+
+class SharedAttachment:
+    """An attachment downloaded once and shared by every delivery of a relayed message"""
+
+    def __init__(self, filename: str, spoiler: bool, description: Optional[str],
+                 data: Optional[bytes] = None, path: Optional[str] = None, content_type: Optional[str] = None):
+        self.filename = filename
+        self.spoiler = spoiler
+        self.description = description
+        self.data = data
+        self.path = path
+        self.content_type = content_type
+
+    @property
+    def spooled(self) -> bool:
+        return self.path is not None
+
+    @property
+    def size(self) -> int:
+        return os.path.getsize(self.path) if self.path is not None else len(self.data or b'')
+
+    def read(self) -> bytes:
+        if self.path is None:
+            return self.data or b''
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def to_file(self) -> discord.File:
+        # A path is opened by discord.File, which then owns the handle and closes it after the upload.
+        # BytesIO over an immutable bytes object shares its buffer instead of copying it.
+        fp = self.path if self.path is not None else io.BytesIO(self.data or b'')
+        return discord.File(fp, filename=self.filename, spoiler=self.spoiler, description=self.description)
+
+    def close(self) -> None:
+        self.data = None
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.error(f"Error deleting spooled attachment {self.path}: {e}")
+            self.path = None
+
+
+# Takes (data or spool path, size, filename), returns a smaller (data, filename) to send instead, or None to keep it
+Shrinker = Callable[[Union[bytes, str], int, str], Optional[Tuple[bytes, str]]]
+# Largest an attachment may be, None for no limit. Anything larger is neither downloaded nor relayed.
+DownloadLimit = Callable[[discord.Attachment], Optional[int]]
+
+
+class AttachmentBundle:
+    def __init__(self, attachments: List[SharedAttachment]):
+        self.attachments = attachments
+
+    def to_files(self) -> List[discord.File]:
+        return [attachment.to_file() for attachment in self.attachments]
+
+    def drop(self, indices: Collection[int]) -> List[str]:
+        """Close and leave out the attachments at indices, returns their filenames"""
+        dropped = [attachment for index, attachment in enumerate(self.attachments) if index in indices]
+        self.attachments = [attachment for index, attachment in enumerate(self.attachments) if index not in indices]
+        for attachment in dropped:
+            attachment.close()
+        return [attachment.filename for attachment in dropped]
+
+    def close(self) -> None:
+        for attachment in self.attachments:
+            attachment.close()
+        self.attachments = []
+
+
+class AttachmentFetcher:
+    """Downloads every attachment of a message once over a shared connection pool, streaming large ones to disk"""
+
+    def __init__(self, spool_threshold: int, connection_limit: int = 20, download_timeout: float = 60,
+                 chunk_size: int = 64 * 1024, spool_dir: Optional[str] = TMPFS_DIR):
+        self.spool_threshold = spool_threshold
+        self.spool_dir = spool_dir
+        self.connection_limit = connection_limit
+        self.download_timeout = download_timeout
+        self.chunk_size = chunk_size
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Created on first use so it belongs to the running loop
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connection_limit, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=self.download_timeout)
+            )
+        return self.session
+
+    async def fetch(self, attachments: Sequence[discord.Attachment],
+                    limit: Optional[DownloadLimit] = None) -> AttachmentBundle:
+        """Download every attachment once, keeping small ones in memory and spooling large ones to disk"""
+        results = await asyncio.gather(*(self._fetch_one(attachment, limit) for attachment in attachments))
+        return AttachmentBundle([shared for shared in results if shared is not None])
+
+    async def _fetch_one(self, attachment: discord.Attachment,
+                         limit: Optional[DownloadLimit]) -> Optional[SharedAttachment]:
+        max_bytes = limit(attachment) if limit else None
+        if max_bytes is not None and (attachment.size or 0) > max_bytes:
+            logger.warning(f"Not relaying {attachment.filename}, {attachment.size} bytes is over the {max_bytes} byte limit.")
+            return None
+
+        shared = SharedAttachment(
+            attachment.filename,
+            attachment.is_spoiler(),
+            attachment.description,
+            content_type=attachment.content_type
+        )
+        try:
+            await self._download(attachment, shared, max_bytes)
+        except asyncio.CancelledError:
+            shared.close()
+            raise
+        except Exception as e:
+            logger.error(f"Failed to download attachment {attachment.filename}, not relaying it: {e}")
+            shared.close()
+            return None
+        return shared
+
+    async def _download(self, attachment: discord.Attachment, shared: SharedAttachment,
+                        max_bytes: Optional[int] = None) -> None:
+        async with self._get_session().get(attachment.url) as response:
+            if response.status != 200:
+                raise ValueError(f"CDN answered {response.status}")
+            if max_bytes is not None and (response.content_length or 0) > max_bytes:
+                raise ValueError(f"{response.content_length} bytes is over the {max_bytes} byte limit")
+
+            buffer = bytearray()
+            spool = None
+            received = 0
+            try:
+                expected = response.content_length or attachment.size or 0
+                if expected > self.spool_threshold:
+                    spool = await self._open_spool(attachment.filename, shared, expected)
+
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    received += len(chunk)
+                    if max_bytes is not None and received > max_bytes:
+                        raise ValueError(f"Larger than announced, stopped past the {max_bytes} byte limit")
+                    if spool is not None:
+                        await spool.write(chunk)
+                        continue
+                    buffer += chunk
+                    if len(buffer) > self.spool_threshold:
+                        # Larger than announced, move what is buffered so far to disk and keep streaming there
+                        spool = await self._open_spool(attachment.filename, shared, max(expected, len(buffer)))
+                        await spool.write(bytes(buffer))
+                        buffer = bytearray()
+            finally:
+                if spool is not None:
+                    await spool.close()
+
+            if spool is None:
+                shared.data = bytes(buffer)
+
+    async def shrink(self, bundle: AttachmentBundle, shrink: Shrinker) -> None:
+        """Shrink the bundle's images once, every target then gets the smaller upload"""
+        await asyncio.gather(*(
+            self._shrink_one(shared, shrink)
+            for shared in bundle.attachments
+            if (shared.content_type or '').startswith('image/')
+        ))
+
+    async def _shrink_one(self, shared: SharedAttachment, shrink: Shrinker) -> None:
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._shrink, shared, shrink)
+        except Exception as e:
+            logger.error(f"Failed to shrink attachment {shared.filename}, sending the original: {e}")
+
+    def _spool_dir(self, expected: int) -> Optional[str]:
+        """The spool dir while it has room to spare for the file, the default temp dir otherwise"""
+        if self.spool_dir is None:
+            return None
+        try:
+            free = shutil.disk_usage(self.spool_dir).free
+        except OSError:
+            return None
+        # A container's /dev/shm is often only 64 MB, a full tmpfs would fail the download
+        return self.spool_dir if expected < free // 2 else None
+
+    async def _open_spool(self, filename: str, shared: SharedAttachment, expected: int):
+        fd, shared.path = tempfile.mkstemp(
+            prefix='beaniverse-',
+            suffix=os.path.splitext(filename)[1],
+            dir=self._spool_dir(expected)
+        )
+        os.close(fd)
+        return await aiofiles.open(shared.path, mode='wb')
+
+    @staticmethod
+    def _shrink(shared: SharedAttachment, shrink: Shrinker) -> None:
+        shrunk = shrink(shared.path if shared.spooled else (shared.data or b''), shared.size, shared.filename)
+        if shrunk is not None:
+            shared.close()
+            shared.data, shared.filename = shrunk
+
+    async def close(self) -> None:
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
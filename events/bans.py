@@ -0,0 +1,193 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Dict, Mapping, Optional, Set, Tuple
+
+from bson.timestamp import Timestamp
+from pymongo.errors import OperationFailure, PyMongoError
+
+from events.database import AsyncCollection
+
+logger = logging.getLogger(__name__)
+
+# Server error codes for a deployment without change streams, and for a stream that cannot be resumed
+CHANGE_STREAMS_UNSUPPORTED = 40573
+CHANGE_STREAM_HISTORY_LOST = 286
+CHANGE_STREAM_FATAL = 280
+
+
+class BanIndex:
+    """In-memory set of active user and server bans, kept in sync with the `bans` collection"""
+
+    def __init__(self, bans: AsyncCollection, poll_interval: float = 30,
+                 retry_delay: float = 1, max_retry_delay: float = 60):
+        self.bans = bans
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.users: Set[int] = set()
+        self.servers: Set[int] = set()
+        self.watermark: Optional[datetime] = None
+        # Where the change stream picks up: the cluster time of the last load, then past the last change seen
+        self.loaded_at: Optional[Timestamp] = None
+        self.resume_token: Optional[Mapping[str, Any]] = None
+        self.stream_failures = 0
+        self._docs: Dict[Any, Tuple[Optional[int], Optional[int]]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def is_banned(self, user_id: Optional[int] = None, server_id: Optional[int] = None) -> bool:
+        if user_id:
+            return user_id in self.users
+        if server_id:
+            return server_id in self.servers
+        return False
+
+    def remove(self, user_id: Optional[int] = None, server_id: Optional[int] = None) -> None:
+        """Lift a ban along with every active document that was covering it"""
+        for doc_id, (doc_user, doc_server) in list(self._docs.items()):
+            if (user_id and doc_user == user_id) or (server_id and doc_server == server_id):
+                del self._docs[doc_id]
+        self._discard(user_id, server_id)
+
+    def _discard(self, user_id: Optional[int], server_id: Optional[int]) -> None:
+        if user_id:
+            self.users.discard(user_id)
+        if server_id:
+            self.servers.discard(server_id)
+
+    def _advance(self, doc: Mapping[str, Any]) -> None:
+        for field in ('timestamp', 'unban_time'):
+            value = doc.get(field)
+            if isinstance(value, datetime) and (self.watermark is None or value > self.watermark):
+                self.watermark = value
+
+    def apply(self, doc: Mapping[str, Any]) -> None:
+        key = (doc.get('user_id'), doc.get('server_id'))
+        if doc.get('active'):
+            self._docs[doc['_id']] = key
+            user_id, server_id = key
+            if user_id:
+                self.users.add(user_id)
+            if server_id:
+                self.servers.add(server_id)
+        else:
+            self._docs.pop(doc['_id'], None)
+            # Another active ban document may still cover the same user or server
+            if key not in self._docs.values():
+                self._discard(*key)
+        self._advance(doc)
+
+    def _forget(self, doc_id: Any) -> None:
+        key = self._docs.pop(doc_id, None)
+        if key and key not in self._docs.values():
+            self._discard(*key)
+
+    async def load(self) -> None:
+        # Taken before the read, so changes made while it runs are replayed by the stream instead of lost
+        loaded_at = await self.bans.operation_time()
+        docs = await self.bans.find(
+            {'active': True},
+            {'user_id': 1, 'server_id': 1, 'active': 1, 'timestamp': 1, 'unban_time': 1}
+        )
+        self.users.clear()
+        self.servers.clear()
+        self._docs.clear()
+        for doc in docs:
+            self.apply(doc)
+        self.loaded_at = loaded_at
+        self.resume_token = None
+        logger.info(f"Loaded {len(self.users)} banned users and {len(self.servers)} banned servers.")
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._sync())
+
+    async def stop(self) -> None:
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _sync(self) -> None:
+        while True:
+            try:
+                await self._watch()
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAMS_UNSUPPORTED:
+                    logger.warning(f"Ban change stream unavailable ({e}), falling back to polling.")
+                    break
+                if e.code in (CHANGE_STREAM_HISTORY_LOST, CHANGE_STREAM_FATAL):
+                    # The stream cannot be resumed from where it stopped, reload and watch from there
+                    logger.warning(f"Ban change stream cannot resume ({e}), reloading bans.")
+                    self.resume_token = None
+                    self.loaded_at = None
+                    await self._retry_load()
+                    continue
+                logger.error(f"Ban change stream failed: {e}")
+            except Exception as e:
+                logger.error(f"Ban change stream failed: {e}")
+            await self._backoff()
+        await self._poll()
+
+    async def _backoff(self) -> None:
+        delay = min(self.retry_delay * 2 ** self.stream_failures, self.max_retry_delay)
+        self.stream_failures += 1
+        logger.info(f"Reopening ban change stream in {delay:.0f}s.")
+        await asyncio.sleep(delay)
+
+    async def _retry_load(self) -> None:
+        while True:
+            try:
+                await self.load()
+                return
+            except PyMongoError as e:
+                logger.error(f"Error reloading bans: {e}")
+                await self._backoff()
+
+    async def _watch(self) -> None:
+        options: Dict[str, Any] = {'full_document': 'updateLookup', 'max_await_time_ms': 1000}
+        if self.resume_token is not None:
+            options['resume_after'] = self.resume_token
+        elif self.loaded_at is not None:
+            options['start_at_operation_time'] = self.loaded_at
+        stream = await self.bans.watch(**options)
+        logger.info("Watching bans collection for changes.")
+        self.stream_failures = 0
+        try:
+            while True:
+                change = await stream.try_next()
+                if change is not None:
+                    if change['operationType'] == 'delete':
+                        self._forget(change['documentKey']['_id'])
+                    elif change.get('fullDocument'):
+                        self.apply(change['fullDocument'])
+                # Also advances on empty batches, so a resume does not replay the whole idle period
+                self.resume_token = stream.resume_token
+        finally:
+            await stream.close()
+
+    async def _poll(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                if self.watermark is None:
+                    await self.load()
+                    continue
+
+                docs = await self.bans.find({
+                    '$or': [
+                        {'timestamp': {'$gt': self.watermark}},
+                        {'unban_time': {'$gt': self.watermark}}
+                    ]
+                })
+                for doc in sorted(docs, key=lambda d: max(
+                    d.get('timestamp') or datetime.min,
+                    d.get('unban_time') or datetime.min
+                )):
+                    self.apply(doc)
+            except PyMongoError as e:
+                logger.error(f"Error polling bans: {e}")
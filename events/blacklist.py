@@ -0,0 +1,61 @@
+from collections import deque
+from typing import Dict, FrozenSet, Iterable, List, Optional
+
+
+class BlacklistMatcher:
+    """Aho-Corasick automaton over the blacklisted terms, scans a message in a single pass"""
+
+    def __init__(self, terms: Iterable[str]):
+        self.terms: FrozenSet[str] = frozenset(term.strip().lower() for term in terms if term.strip())
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        # Term recognised on reaching each state, either its own or one inherited through the fail links
+        self._match: List[Optional[str]] = [None]
+
+        for term in sorted(self.terms):
+            self._insert(term)
+        self._link()
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    def _insert(self, term: str) -> None:
+        state = 0
+        for char in term:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._match.append(None)
+            state = next_state
+        self._match[state] = term
+
+    def _link(self) -> None:
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self._goto[state].items():
+                queue.append(child)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(char, 0)
+                if self._match[child] is None:
+                    self._match[child] = self._match[self._fail[child]]
+
+    def find(self, content: str) -> Optional[str]:
+        """Return the first blacklisted term found in content, or None"""
+        if not self.terms:
+            return None
+
+        goto, fail, match = self._goto, self._fail, self._match
+        state = 0
+        for char in content.lower():
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if match[state] is not None:
+                return match[state]
+        return None
@@ -0,0 +1,179 @@
+import asyncio
+import functools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Mapping, Optional
+
+from bson.timestamp import Timestamp
+from pymongo import MongoClient, ReadPreference
+from pymongo.collection import Collection
+from pymongo.read_concern import ReadConcern
+from pymongo.write_concern import WriteConcern
+
+logger = logging.getLogger(__name__)
+
+_READ_PREFERENCES = {
+    'primary': 'PRIMARY',
+    'primaryPreferred': 'PRIMARY_PREFERRED',
+    'secondary': 'SECONDARY',
+    'secondaryPreferred': 'SECONDARY_PREFERRED',
+    'nearest': 'NEAREST'
+}
+
+
+class AsyncCollection:
+    """Awaitable wrapper around a pymongo collection, every call runs on the database executor"""
+
+    def __init__(self, collection: Collection, executor: ThreadPoolExecutor):
+        self.collection = collection
+        self.executor = executor
+
+    @property
+    def name(self) -> str:
+        return self.collection.name
+
+    async def _run(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def find_one(self, *args, **kwargs) -> Optional[Dict[str, Any]]:
+        return await self._run(self.collection.find_one, *args, **kwargs)
+
+    async def find(self, *args, **kwargs) -> List[Dict[str, Any]]:
+        # The cursor is drained on the executor too, iterating it would fetch batches on the loop
+        return await self._run(lambda: list(self.collection.find(*args, **kwargs)))
+
+    async def count_documents(self, *args, **kwargs) -> int:
+        return await self._run(self.collection.count_documents, *args, **kwargs)
+
+    async def insert_one(self, *args, **kwargs):
+        return await self._run(self.collection.insert_one, *args, **kwargs)
+
+    async def insert_many(self, *args, **kwargs):
+        return await self._run(self.collection.insert_many, *args, **kwargs)
+
+    async def update_one(self, *args, **kwargs):
+        return await self._run(self.collection.update_one, *args, **kwargs)
+
+    async def update_many(self, *args, **kwargs):
+        return await self._run(self.collection.update_many, *args, **kwargs)
+
+    async def delete_one(self, *args, **kwargs):
+        return await self._run(self.collection.delete_one, *args, **kwargs)
+
+    async def delete_many(self, *args, **kwargs):
+        return await self._run(self.collection.delete_many, *args, **kwargs)
+
+    async def find_one_and_update(self, *args, **kwargs) -> Optional[Dict[str, Any]]:
+        return await self._run(self.collection.find_one_and_update, *args, **kwargs)
+
+    async def find_one_and_delete(self, *args, **kwargs) -> Optional[Dict[str, Any]]:
+        return await self._run(self.collection.find_one_and_delete, *args, **kwargs)
+
+    async def bulk_write(self, *args, **kwargs):
+        return await self._run(self.collection.bulk_write, *args, **kwargs)
+
+    async def create_index(self, *args, **kwargs) -> str:
+        return await self._run(self.collection.create_index, *args, **kwargs)
+
+    async def operation_time(self) -> Optional[Timestamp]:
+        """Current cluster time of this collection's database, None on a standalone server"""
+        response = await self._run(self.collection.database.command, 'ping')
+        return response.get('operationTime')
+
+    async def watch(self, *args, **kwargs) -> 'AsyncChangeStream':
+        stream = await self._run(self.collection.watch, *args, **kwargs)
+        return AsyncChangeStream(stream, self.executor)
+
+
+class AsyncChangeStream:
+    def __init__(self, stream, executor: ThreadPoolExecutor):
+        self.stream = stream
+        self.executor = executor
+
+    @property
+    def resume_token(self) -> Optional[Mapping[str, Any]]:
+        """Where the stream can be resumed, past the last change it returned"""
+        return self.stream.resume_token
+
+    async def try_next(self) -> Optional[Dict[str, Any]]:
+        """Wait up to the stream's max_await_time_ms for the next change, None if nothing arrived"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.stream.try_next)
+
+    async def close(self) -> None:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.stream.close)
+
+
+class DatabaseConfig:
+    def __init__(self):
+        self.uri = os.getenv('MONGODB_URI')
+        self.name = os.getenv('MONGODB_DATABASE', 'global_chat')
+        self.max_pool_size = int(os.getenv('MONGODB_MAX_POOL_SIZE', '50'))
+        self.min_pool_size = int(os.getenv('MONGODB_MIN_POOL_SIZE', '0'))
+        self.server_selection_timeout_ms = int(os.getenv('MONGODB_SERVER_SELECTION_TIMEOUT_MS', '5000'))
+        self.connect_timeout_ms = int(os.getenv('MONGODB_CONNECT_TIMEOUT_MS', '5000'))
+        self.socket_timeout_ms = int(os.getenv('MONGODB_SOCKET_TIMEOUT_MS', '10000'))
+        self.write_concern = os.getenv('MONGODB_WRITE_CONCERN')
+        self.read_concern = os.getenv('MONGODB_READ_CONCERN')
+        self.read_preference = os.getenv('MONGODB_READ_PREFERENCE', 'primary')
+
+    def client_options(self) -> Dict[str, Any]:
+        return {
+            'maxPoolSize': self.max_pool_size,
+            'minPoolSize': self.min_pool_size,
+            'serverSelectionTimeoutMS': self.server_selection_timeout_ms,
+            'connectTimeoutMS': self.connect_timeout_ms,
+            'socketTimeoutMS': self.socket_timeout_ms,
+            'appname': 'beaniverse-v2'
+        }
+
+    def database_options(self) -> Dict[str, Any]:
+        """Concerns left unset fall back to the server's defaults"""
+        options: Dict[str, Any] = {
+            'read_preference': getattr(ReadPreference, _READ_PREFERENCES[self.read_preference])
+        }
+        if self.write_concern:
+            w = int(self.write_concern) if self.write_concern.isdigit() else self.write_concern
+            options['write_concern'] = WriteConcern(w=w)
+        if self.read_concern:
+            options['read_concern'] = ReadConcern(self.read_concern)
+        return options
+
+
+class Database:
+    """Process-wide data-access layer, keeps blocking pymongo I/O off the event loop"""
+
+    def __init__(self, config: DatabaseConfig):
+        if not config.uri:
+            raise ValueError("MONGODB_URI not found in environment variables")
+
+        self.config = config
+        self.client = MongoClient(config.uri, **config.client_options())
+        self.db = self.client.get_database(config.name, **config.database_options())
+        # One executor thread per pooled connection, more would only queue inside pymongo
+        self.executor = ThreadPoolExecutor(max_workers=config.max_pool_size, thread_name_prefix='mongo')
+        self._collections: Dict[str, AsyncCollection] = {}
+        self._closed = False
+
+    def __getitem__(self, name: str) -> AsyncCollection:
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections[name] = AsyncCollection(self.db[name], self.executor)
+        return collection
+
+    async def ping(self) -> None:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.client.admin.command, 'ping')
+
+    async def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.client.close)
+        self.executor.shutdown(wait=False)
+        logger.info("MongoDB connection closed.")
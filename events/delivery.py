@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+import discord
+
+from events.attachments import AttachmentBundle
+from events.fanout import DELIVERED, FAILED, FanoutEngine, FanoutStats
+
+logger = logging.getLogger(__name__)
+
+
+class RelayLedger:
+    """Copies of one relayed message sent so far, kept so they can be retracted if a later scan flags it"""
+
+    def __init__(self, message_id: int):
+        self.message_id = message_id
+        self.copies: List[Tuple[int, discord.Webhook, int]] = []
+        self.retracted = False
+        self._late: List[asyncio.Task] = []
+
+    def record(self, channel_id: int, webhook: discord.Webhook, message_id: int) -> None:
+        if self.retracted:
+            # Delivery finished after the retraction started, take this copy down straight away
+            self._late.append(asyncio.create_task(self._delete(channel_id, webhook, message_id)))
+            return
+        self.copies.append((channel_id, webhook, message_id))
+
+    async def retract(self, engine: FanoutEngine) -> int:
+        """Delete every copy sent so far and refuse any still queued, returns how many were deleted"""
+        self.retracted = True
+        copies, self.copies = self.copies, []
+        outcomes = await asyncio.gather(*(
+            engine.deliver(channel_id, lambda copy=(channel_id, webhook, message_id): self._delete(*copy))
+            for channel_id, webhook, message_id in copies
+        ))
+        return sum(outcome == DELIVERED for outcome in outcomes)
+
+    async def _delete(self, channel_id: int, webhook: discord.Webhook, message_id: int) -> bool:
+        try:
+            await webhook.delete_message(message_id)
+            return True
+        except discord.NotFound:
+            return True
+        except Exception as e:
+            logger.error(f"Failed to retract relayed message {message_id} in channel {channel_id}: {e}")
+            return False
+
+
+class Envelope:
+    """One relayed message (or a burst of them merged together) on its way to a single channel"""
+
+    def __init__(self, message_ids: List[int], author_id: int, username: str, avatar_url: str,
+                 content: str, attachments: Optional[AttachmentBundle], stats: List[FanoutStats],
+                 ledger: Optional[RelayLedger] = None):
+        self.message_ids = message_ids
+        self.author_id = author_id
+        self.username = username
+        self.avatar_url = avatar_url
+        self.content = content
+        self.attachments = attachments
+        self.stats = stats
+        self.ledger = ledger
+
+    @property
+    def coalescable(self) -> bool:
+        # A copy that may be retracted must stay a message of its own
+        return not (self.attachments and self.attachments.attachments) and self.ledger is None
+
+    def can_merge(self, other: 'Envelope', max_length: int) -> bool:
+        return (
+            self.coalescable
+            and other.coalescable
+            and other.author_id == self.author_id
+            and other.username == self.username
+            and other.avatar_url == self.avatar_url
+            and len(self.content) + 1 + len(other.content) <= max_length
+        )
+
+    def merge(self, other: 'Envelope') -> 'Envelope':
+        return Envelope(
+            self.message_ids + other.message_ids,
+            self.author_id,
+            self.username,
+            self.avatar_url,
+            f"{self.content}\n{other.content}",
+            None,
+            self.stats + other.stats
+        )
+
+    def record(self, outcome: str) -> None:
+        for stats in self.stats:
+            stats.record(outcome)
+
+
+class ChannelQueue:
+    DRAIN_RATE_WINDOW = 60
+
+    def __init__(self, channel_id: int):
+        self.channel_id = channel_id
+        self.pending: Deque[Envelope] = deque()
+        self.worker: Optional[asyncio.Task] = None
+        self.drained_total = 0
+        self.coalesced = 0
+        self.drained: Deque[float] = deque()
+
+    @property
+    def depth(self) -> int:
+        return len(self.pending)
+
+    def record_drain(self, count: int) -> None:
+        now = time.monotonic()
+        self.drained.extend([now] * count)
+        self.drained_total += count
+        while self.drained and now - self.drained[0] > self.DRAIN_RATE_WINDOW:
+            self.drained.popleft()
+
+    @property
+    def drain_rate(self) -> float:
+        """Messages drained per second over the last DRAIN_RATE_WINDOW seconds"""
+        now = time.monotonic()
+        while self.drained and now - self.drained[0] > self.DRAIN_RATE_WINDOW:
+            self.drained.popleft()
+        return len(self.drained) / self.DRAIN_RATE_WINDOW
+
+
+class DeliveryManager:
+    """Ordered per-channel delivery queues, each drained by its own worker task"""
+
+    def __init__(self, engine: FanoutEngine, send: Callable[[int, Envelope], Awaitable[bool]], max_length: int = 2000):
+        self.engine = engine
+        self.send = send
+        self.max_length = max_length
+        self.queues: Dict[int, ChannelQueue] = {}
+        self.closed = False
+
+    def enqueue(self, channel_id: int, envelope: Envelope) -> None:
+        if self.closed:
+            envelope.record(FAILED)
+            return
+
+        queue = self.queues.get(channel_id)
+        if queue is None:
+            queue = self.queues[channel_id] = ChannelQueue(channel_id)
+
+        queue.pending.append(envelope)
+        if queue.worker is None or queue.worker.done():
+            queue.worker = asyncio.create_task(self._drain(queue))
+
+    def _next_batch(self, queue: ChannelQueue) -> Envelope:
+        envelope = queue.pending.popleft()
+        # Only merge when the queue has backed up, a caught-up channel gets every message as is
+        while queue.pending and envelope.can_merge(queue.pending[0], self.max_length):
+            envelope = envelope.merge(queue.pending.popleft())
+            queue.coalesced += 1
+        return envelope
+
+    async def _drain(self, queue: ChannelQueue) -> None:
+        while queue.pending:
+            envelope = self._next_batch(queue)
+            try:
+                outcome = await self.engine.deliver(queue.channel_id, lambda: self.send(queue.channel_id, envelope))
+            except asyncio.CancelledError:
+                envelope.record(FAILED)
+                raise
+            envelope.record(outcome)
+            queue.record_drain(len(envelope.message_ids))
+
+    def stats(self) -> Dict[int, Dict[str, float]]:
+        return {
+            channel_id: {
+                'depth': queue.depth,
+                'drained': queue.drained_total,
+                'coalesced': queue.coalesced,
+                'drain_rate': queue.drain_rate
+            }
+            for channel_id, queue in self.queues.items()
+        }
+
+    def summary(self, top: int = 5) -> Dict[str, Any]:
+        """Totals over every channel queue, with the deepest queues listed by channel id"""
+        queues = self.stats()
+        deepest = sorted(queues.items(), key=lambda item: item[1]['depth'], reverse=True)[:top]
+        return {
+            'channels': len(queues),
+            'depth': sum(queue['depth'] for queue in queues.values()),
+            'drain_rate': sum(queue['drain_rate'] for queue in queues.values()),
+            'drained': sum(queue['drained'] for queue in queues.values()),
+            'coalesced': sum(queue['coalesced'] for queue in queues.values()),
+            'deepest': {channel_id: queue['depth'] for channel_id, queue in deepest if queue['depth']},
+            **self.engine.totals
+        }
+
+    async def close(self) -> None:
+        self.closed = True
+        workers = [queue.worker for queue in self.queues.values() if queue.worker and not queue.worker.done()]
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+        for queue in self.queues.values():
+            while queue.pending:
+                queue.pending.popleft().record(FAILED)
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+DELIVERED = 'delivered'
+FAILED = 'failed'
+TIMED_OUT = 'timed_out'
+
+
+class FanoutStats:
+    def __init__(self, message_id: int, total: int):
+        self.message_id = message_id
+        self.total = total
+        self.delivered = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.started_at = time.perf_counter()
+        self.first_delivery: Optional[float] = None
+        self.last_delivery: Optional[float] = None
+        self._done = asyncio.Event()
+        if total == 0:
+            self._done.set()
+
+    @property
+    def completed(self) -> int:
+        return self.delivered + self.failed + self.timed_out
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started_at
+
+    def record(self, outcome: str) -> None:
+        if outcome == DELIVERED:
+            self.delivered += 1
+            now = self.elapsed
+            if self.first_delivery is None:
+                self.first_delivery = now
+            self.last_delivery = now
+        elif outcome == TIMED_OUT:
+            self.timed_out += 1
+        else:
+            self.failed += 1
+
+        if self.completed >= self.total:
+            self._done.set()
+
+    async def wait(self) -> None:
+        await self._done.wait()
+
+    def summary(self) -> str:
+        first = f"{self.first_delivery * 1000:.0f}ms" if self.first_delivery is not None else "n/a"
+        last = f"{self.last_delivery * 1000:.0f}ms" if self.last_delivery is not None else "n/a"
+        return (
+            f"{self.delivered}/{self.total} delivered, {self.failed} failed, "
+            f"{self.timed_out} timed out, first {first}, last {last}, "
+            f"total {self.elapsed * 1000:.0f}ms"
+        )
+
+
+class FanoutEngine:
+    def __init__(self, concurrency: int = 50, timeout: float = 10.0):
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.totals: Dict[str, int] = {DELIVERED: 0, FAILED: 0, TIMED_OUT: 0}
+
+    async def deliver(self, target_id: int, send: Callable[[], Awaitable[bool]]) -> str:
+        """Run a single send under the concurrency limit and the per-target timeout"""
+        async with self.semaphore:
+            try:
+                outcome = DELIVERED if await asyncio.wait_for(send(), timeout=self.timeout) else FAILED
+            except asyncio.TimeoutError:
+                logger.warning(f"Delivery to channel {target_id} timed out after {self.timeout}s.")
+                outcome = TIMED_OUT
+            except Exception as e:
+                logger.error(f"Delivery to channel {target_id} failed: {e}")
+                outcome = FAILED
+
+        self.totals[outcome] += 1
+        return outcome
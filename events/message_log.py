@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+from pymongo.errors import BulkWriteError
+
+from events.database import AsyncCollection
+
+logger = logging.getLogger(__name__)
+
+
+class MessageLogBuffer:
+    """Write-behind buffer for `message_logs`, flushed with insert_many on size or time thresholds"""
+
+    def __init__(self, collection: AsyncCollection, batch_size: int = 500,
+                 flush_interval: float = 2.0, max_buffered: int = 10000):
+        self.collection = collection
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_buffered = max(self.batch_size, max_buffered)
+        self.pending: Deque[Dict[str, Any]] = deque()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+        self.written = 0
+        self.dropped = 0
+        self.failed_flushes = 0
+        self.high_watermark = 0
+        self.last_flush_ms = 0.0
+
+    def add(self, doc: Dict[str, Any]) -> None:
+        if len(self.pending) >= self.max_buffered:
+            # Bounded memory: under sustained backpressure the oldest entries go first
+            self.pending.popleft()
+            self.dropped += 1
+
+        self.pending.append(doc)
+        self.high_watermark = max(self.high_watermark, len(self.pending))
+        if len(self.pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'buffered': len(self.pending),
+            'high_watermark': self.high_watermark,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed_flushes': self.failed_flushes,
+            'last_flush_ms': self.last_flush_ms
+        }
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            # Shielded so cancelling the loop on close never abandons a batch mid-write
+            await asyncio.shield(self.flush())
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            while self.pending:
+                batch: List[Dict[str, Any]] = [
+                    self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))
+                ]
+                started = time.perf_counter()
+                try:
+                    await self.collection.insert_many(batch, ordered=False)
+                    self.written += len(batch)
+                except BulkWriteError as e:
+                    inserted = e.details.get('nInserted', 0)
+                    self.written += inserted
+                    self.dropped += len(batch) - inserted
+                    logger.error(f"Failed to log {len(batch) - inserted} of {len(batch)} messages: {e}")
+                except Exception as e:
+                    self.failed_flushes += 1
+                    logger.error(f"Failed to flush {len(batch)} message logs: {e}")
+                    # Put the batch back for the next flush, add() keeps the buffer bounded
+                    free = self.max_buffered - len(self.pending)
+                    self.pending.extendleft(reversed(batch[-free:] if free > 0 else []))
+                    self.dropped += max(0, len(batch) - max(free, 0))
+                    return
+                finally:
+                    self.last_flush_ms = (time.perf_counter() - started) * 1000
+
+    async def close(self) -> None:
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        logger.info(f"Message log buffer flushed, {self.written} written, {self.dropped} dropped.")
@@ -0,0 +1,167 @@
+import bisect
+import logging
+import re
+import time
+import unicodedata
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Collection, Dict, Iterable, List, Optional, Tuple
+
+import discord
+
+from events.blacklist import BlacklistMatcher
+
+logger = logging.getLogger(__name__)
+
+COST_TRIVIAL = 0
+COST_CHEAP = 1
+COST_MODERATE = 2
+COST_EXPENSIVE = 3
+
+# A stage returning this rejects the message without a reason, so the author is not muted
+REJECT_SILENTLY = ''
+
+LATENCY_BUCKETS_MS = (0.05, 0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000)
+
+ZERO_WIDTH = dict.fromkeys(map(ord, '\u00ad\u180e\u200b\u200c\u200d\u2060\u2061\u2062\u2063\u2064\ufeff'))
+
+# Look-alike letters that survive NFKC, folded onto the latin letter they imitate
+CONFUSABLES = str.maketrans({
+    '\u0430': 'a', '\u0432': 'b', '\u0435': 'e', '\u0451': 'e', '\u043a': 'k', '\u043c': 'm',
+    '\u043d': 'h', '\u043e': 'o', '\u0440': 'p', '\u0441': 'c', '\u0442': 't', '\u0443': 'y',
+    '\u0445': 'x', '\u0455': 's', '\u0456': 'i', '\u0457': 'i', '\u0458': 'j', '\u0501': 'd',
+    '\u04cf': 'l', '\u051b': 'q', '\u051d': 'w', '\u0261': 'g', '\u0251': 'a', '\u0131': 'i',
+    '\u03b1': 'a', '\u03b2': 'b', '\u03b5': 'e', '\u03b9': 'i', '\u03ba': 'k', '\u03bd': 'v',
+    '\u03bf': 'o', '\u03c1': 'p', '\u03c4': 't', '\u03c5': 'u', '\u03c7': 'x', '\u03c9': 'w'
+})
+
+LINK_PATTERN = re.compile(
+    r'(?P<invite>'
+    r'(?:https?://)?(?:www\.)?((?:discord\.(?:gg|io|me|li|com)|discordapp\.com)/(?:invite/)?[a-zA-Z0-9-]+)'
+    r')|(?P<adult>'
+    r'(?:https?://)?(?:www\.)?'
+    r'(?:'
+    r'(?:[a-zA-Z0-9\-]+\.)*(?:porn|pinayflix|jakol|hubad|iyot|kayat|kantot|xxx|sex|adult|nsfw|hentai|xvideos|pornhub|xnxx|xhamster|redtube|youporn)'
+    r'(?:\.[a-zA-Z]{2,})\b'
+    r'|'
+    r'(?:only\.)?fans/|onlyfans\.com'
+    r')'
+    r')',
+    re.IGNORECASE
+)
+
+LINK_REASONS = {
+    'invite': "Discord invites are not allowed",
+    'adult': "Adult content links are not allowed"
+}
+
+
+class ContentScanner:
+    """Normalizes a message once and runs the link and blacklist rules over the result"""
+
+    def __init__(self, cache_size: int = 4096, cacheable_length: int = 256):
+        self.cacheable_length = cacheable_length
+        self._normalize_cached = lru_cache(maxsize=cache_size)(self._normalize)
+
+    @staticmethod
+    def _normalize(content: str) -> str:
+        text = content.translate(ZERO_WIDTH)
+        text = unicodedata.normalize('NFKC', text).casefold()
+        # NFKC can compose new zero-width sequences out of compatibility characters
+        return text.translate(CONFUSABLES).translate(ZERO_WIDTH)
+
+    def normalize(self, content: str) -> str:
+        if len(content) <= self.cacheable_length:
+            return self._normalize_cached(content)
+        return self._normalize(content)
+
+    def scan(self, content: str, blacklist: BlacklistMatcher) -> Optional[Tuple[str, str]]:
+        """Return (rule, reason) for the first rule the content breaks, or None if it is clean"""
+        if not content:
+            return None
+
+        text = self.normalize(content)
+
+        # Every link rule needs a dot or a slash, plain chat skips the regex entirely
+        if '.' in text or '/' in text:
+            match = LINK_PATTERN.search(text)
+            if match:
+                rule = 'invite' if match.group('invite') else 'adult'
+                return rule, LINK_REASONS[rule]
+
+        word = blacklist.find(text)
+        if word:
+            return 'blacklist', f"Message contains prohibited words ({word})"
+
+        return None
+
+    def cache_info(self):
+        return self._normalize_cached.cache_info()
+
+
+class StageStats:
+    def __init__(self):
+        self.calls = 0
+        self.rejections = 0
+        self.total_ms = 0.0
+        # One count per LATENCY_BUCKETS_MS upper bound, the last slot holds everything slower
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def record(self, elapsed_ms: float, rejected: bool) -> None:
+        self.calls += 1
+        if rejected:
+            self.rejections += 1
+        self.total_ms += elapsed_ms
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'calls': self.calls,
+            'rejections': self.rejections,
+            'avg_ms': self.total_ms / self.calls if self.calls else 0.0,
+            'histogram': dict(zip([*map(str, LATENCY_BUCKETS_MS), 'inf'], self.histogram))
+        }
+
+
+class ModerationStage:
+    def __init__(self, name: str, cost: int, check: Callable[[discord.Message], Awaitable[Optional[str]]],
+                 required: bool = False):
+        self.name = name
+        self.cost = cost
+        self.check = check
+        self.required = required
+        self.stats = StageStats()
+
+
+class ModerationPipeline:
+    """Registered moderation stages, run cheapest first until one rejects the message"""
+
+    def __init__(self, disabled: Iterable[str] = ()):
+        self.disabled = {name.strip() for name in disabled if name.strip()}
+        self.stages: List[ModerationStage] = []
+
+    def register(self, name: str, cost: int, check: Callable[[discord.Message], Awaitable[Optional[str]]],
+                 required: bool = False) -> None:
+        if not required and name in self.disabled:
+            logger.info(f"Moderation stage '{name}' is disabled.")
+            return
+        self.stages.append(ModerationStage(name, cost, check, required))
+        # sort is stable, stages of the same cost keep their registration order
+        self.stages.sort(key=lambda stage: stage.cost)
+
+    def __contains__(self, name: str) -> bool:
+        return any(stage.name == name for stage in self.stages)
+
+    async def run(self, message: discord.Message, skip: Collection[str] = ()) -> Optional[str]:
+        """Return the first rejection reason (REJECT_SILENTLY for no reason), or None if every stage passes"""
+        for stage in self.stages:
+            if stage.name in skip:
+                continue
+            started = time.perf_counter()
+            reason = await stage.check(message)
+            stage.stats.record((time.perf_counter() - started) * 1000, reason is not None)
+            if reason is not None:
+                return reason
+        return None
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {stage.name: stage.stats.to_dict() for stage in self.stages}
@@ -0,0 +1,556 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import shutil
+import signal
+import struct
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import discord
+from dotenv import load_dotenv
+
+from events.attachments import AttachmentBundle, SharedAttachment
+from events.nsfw import (
+    DetectorBase,
+    ImagePreprocessor,
+    NSFWDetector,
+    ScanResult,
+    VIDEO_SPOOL_DIR,
+    available_cpus,
+    scan_kind,
+    scan_source
+)
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WARMUP_SAMPLE = os.path.join(BASE_DIR, 'assets', 'nsfw_warmup.png')
+
+# Every frame is a 4-byte big-endian length followed by that many bytes of JSON
+FRAME_HEADER = struct.Struct('>I')
+MAX_FRAME_SIZE = 1024 * 1024
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Dict[str, Any]:
+    (length,) = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {length} bytes is over the {MAX_FRAME_SIZE} byte limit")
+    return json.loads(await reader.readexactly(length))
+
+
+def encode_frame(payload: Dict[str, Any]) -> bytes:
+    data = json.dumps(payload, separators=(',', ':')).encode()
+    return FRAME_HEADER.pack(len(data)) + data
+
+
+def share_attachments(attachments: AttachmentBundle) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """Describe a downloaded bundle for a worker, writing in-memory files to tmpfs so the worker reads, not downloads, them"""
+    records = []
+    written = []
+    for attachment in attachments.attachments:
+        path = attachment.path
+        if path is None and scan_kind(attachment.content_type, attachment.filename):
+            fd, path = tempfile.mkstemp(
+                prefix='beaniverse-scan-',
+                suffix=os.path.splitext(attachment.filename)[1],
+                dir=VIDEO_SPOOL_DIR
+            )
+            with os.fdopen(fd, 'wb') as f:
+                f.write(attachment.data or b'')
+            written.append(path)
+        records.append({'filename': attachment.filename, 'content_type': attachment.content_type, 'path': path})
+    return records, written
+
+
+def remove_files(paths: List[str]) -> None:
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+class ModerationWorkerServer:
+    """Answers scan and ping requests from the bot, each job bounded by the deadline it was sent with"""
+
+    def __init__(self, detector: NSFWDetector):
+        self.detector = detector
+        self.writers: Set[asyncio.StreamWriter] = set()
+        self.jobs = 0
+        self.timeouts = 0
+        self.active = 0
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.writers.add(writer)
+        write_lock = asyncio.Lock()
+        tasks: Set[asyncio.Task] = set()
+        try:
+            while True:
+                request = await read_frame(reader)
+                task = asyncio.create_task(self._answer(request, writer, write_lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"Dropping moderation client after a bad frame: {e}")
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.writers.discard(writer)
+            writer.close()
+
+    async def _answer(self, request: Dict[str, Any], writer: asyncio.StreamWriter, write_lock: asyncio.Lock) -> None:
+        response = await self._handle_request(request)
+        async with write_lock:
+            writer.write(encode_frame(response))
+            await writer.drain()
+
+    async def _handle_request(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        op = request.get('op')
+        job_id = request.get('id')
+
+        if op == 'ping':
+            return {
+                'id': job_id,
+                'ok': True,
+                'pid': os.getpid(),
+                'ready': self.detector.ready.is_set(),
+                'active': self.active
+            }
+
+        if op == 'stats':
+            return {'id': job_id, 'ok': True, 'stats': {**self.detector.stats(), 'jobs': self.jobs, 'timeouts': self.timeouts}}
+
+        if op == 'forget':
+            forgotten = await self.detector.forget_hash(request['hash'], request.get('cleared_by'))
+            return {'id': job_id, 'ok': True, 'forgotten': forgotten}
+
+        if op != 'scan':
+            return {'id': job_id, 'ok': False, 'error': f"Unknown op {op}"}
+
+        self.jobs += 1
+        self.active += 1
+        try:
+            # The files belong to the bot, which deletes them once the job is answered
+            attachments = AttachmentBundle([
+                SharedAttachment(record['filename'], False, None, path=record['path'], content_type=record['content_type'])
+                for record in request.get('attachments', [])
+            ])
+            result = await asyncio.wait_for(
+                self._scan(attachments, request.get('source')),
+                timeout=request.get('deadline')
+            )
+            return {'id': job_id, 'ok': True, 'result': result.to_dict()}
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return {'id': job_id, 'ok': False, 'error': "Deadline exceeded"}
+        except Exception as e:
+            return {'id': job_id, 'ok': False, 'error': str(e)}
+        finally:
+            self.active -= 1
+
+    async def _scan(self, attachments: AttachmentBundle, source: Optional[Dict[str, Any]]) -> ScanResult:
+        # The bot applies the unready policy, a job that reaches the worker waits for the model
+        await self.detector.ready.wait()
+        return await self.detector.check_attachments(attachments, source)
+
+    def close_clients(self) -> None:
+        for writer in list(self.writers):
+            writer.close()
+
+
+async def run_worker(socket_path: str, parent_pid: Optional[int] = None, pool_size: Optional[int] = None) -> None:
+    database = None
+    hashes = None
+    if os.getenv('MONGODB_URI'):
+        from events.database import Database, DatabaseConfig
+        database = Database(DatabaseConfig())
+        hashes = database['nsfw_hashes']
+
+    detector = NSFWDetector.from_env(hashes, pool_size)
+    try:
+        await detector.setup_indexes()
+        loaded = await detector.load_hashes()
+        logger.info(f"Loaded {loaded} known NSFW image hashes.")
+    except Exception as e:
+        logger.error(f"Error loading NSFW image hashes: {e}")
+
+    server = ModerationWorkerServer(detector)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    unix_server = await asyncio.start_unix_server(server.handle, path=socket_path)
+    os.chmod(socket_path, 0o600)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    warm_up = asyncio.create_task(detector.warm_up(WARMUP_SAMPLE))
+    logger.info(f"Moderation worker {os.getpid()} listening on {socket_path}.")
+
+    try:
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                pass
+            if parent_pid is not None and os.getppid() != parent_pid:
+                logger.warning("Bot process is gone, shutting the moderation worker down.")
+                break
+    finally:
+        unix_server.close()
+        server.close_clients()
+        await unix_server.wait_closed()
+        warm_up.cancel()
+        await detector.cleanup()
+        if database is not None:
+            await database.close()
+        try:
+            os.unlink(socket_path)
+        except FileNotFoundError:
+            pass
+
+
+class WorkerHandle:
+    """One supervised worker process and the connection to it"""
+
+    def __init__(self, index: int, socket_path: str, pool_size: int):
+        self.index = index
+        self.socket_path = socket_path
+        self.pool_size = pool_size
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.write_lock = asyncio.Lock()
+        self.reader_task: Optional[asyncio.Task] = None
+        self.connected = False
+
+        self.restarts = 0
+        self.jobs = 0
+        self.timeouts = 0
+        self.failures = 0
+
+    @property
+    def alive(self) -> bool:
+        return self.connected and self.process is not None and self.process.returncode is None
+
+    async def start(self, connect_timeout: float) -> None:
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, '-m', 'events.moderation_worker',
+            '--socket', self.socket_path,
+            '--parent-pid', str(os.getpid()),
+            '--pool-size', str(self.pool_size),
+            cwd=BASE_DIR
+        )
+
+        deadline = time.monotonic() + connect_timeout
+        while True:
+            if self.process.returncode is not None:
+                raise RuntimeError(f"exited with code {self.process.returncode} during startup")
+            try:
+                self.reader, self.writer = await asyncio.open_unix_connection(self.socket_path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"socket not up after {connect_timeout}s")
+                await asyncio.sleep(0.2)
+
+        self.connected = True
+        self.reader_task = asyncio.create_task(self._read())
+
+    async def _read(self) -> None:
+        try:
+            while True:
+                response = await read_frame(self.reader)
+                future = self.pending.pop(response.get('id'), None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except asyncio.IncompleteReadError:
+            pass
+        except Exception as e:
+            logger.error(f"Lost moderation worker {self.index}: {e}")
+        finally:
+            self.connected = False
+            self._fail_pending(ConnectionError(f"Moderation worker {self.index} disconnected"))
+
+    def _fail_pending(self, error: Exception) -> None:
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    async def request(self, payload: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+        if not self.alive:
+            raise ConnectionError(f"Moderation worker {self.index} is not running")
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending[payload['id']] = future
+        try:
+            async with self.write_lock:
+                self.writer.write(encode_frame(payload))
+                await self.writer.drain()
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(payload['id'], None)
+
+    async def stop(self) -> None:
+        self.connected = False
+        if self.reader_task and not self.reader_task.done():
+            self.reader_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+        if self.process is not None and self.process.returncode is None:
+            self.process.terminate()
+            try:
+                await asyncio.wait_for(self.process.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                self.process.kill()
+                await self.process.wait()
+        self._fail_pending(ConnectionError(f"Moderation worker {self.index} stopped"))
+
+
+class RemoteNSFWDetector(DetectorBase):
+    """NSFWDetector's interface, with the scanning done by supervised moderation worker processes"""
+
+    @classmethod
+    def from_env(cls) -> 'RemoteNSFWDetector':
+        return cls(
+            workers=int(os.getenv('MODERATION_WORKERS', '1')),
+            job_deadline=float(os.getenv('MODERATION_JOB_DEADLINE', '30')),
+            health_interval=float(os.getenv('MODERATION_HEALTH_INTERVAL', '10')),
+            **cls.settings_from_env()
+        )
+
+    def __init__(self, workers: int = 1, job_deadline: float = 30, health_interval: float = 10,
+                 health_timeout: float = 5, connect_timeout: float = 60, unready_policy: str = 'hold',
+                 max_image_bytes: int = 20 * 1024 * 1024, max_video_bytes: int = 100 * 1024 * 1024,
+                 preprocessor: Optional[ImagePreprocessor] = None):
+        # Forwarding copies are still shrunk in the bot process, they are uploaded from here
+        super().__init__(max_image_bytes, max_video_bytes, preprocessor, unready_policy)
+        self.socket_dir = tempfile.mkdtemp(prefix='beaniverse-moderation-')
+        workers = max(1, workers)
+        # The cores are split between the workers, each runs its own inference pool
+        pool_size = max(1, available_cpus() // workers)
+        self.workers = [
+            WorkerHandle(index, os.path.join(self.socket_dir, f'worker-{index}.sock'), pool_size)
+            for index in range(workers)
+        ]
+        self.job_deadline = job_deadline
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.connect_timeout = connect_timeout
+
+        self._ids = itertools.count(1)
+        self._supervisor: Optional[asyncio.Task] = None
+        self.closed = False
+
+    async def setup_indexes(self) -> None:
+        # The workers own the nsfw_hashes collection
+        return None
+
+    async def load_hashes(self) -> int:
+        return 0
+
+    async def warm_up(self, sample_path: str) -> None:
+        """Start the workers and wait for each to warm its model up, each one uses its own bundled sample"""
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(self._start(worker) for worker in self.workers))
+            warm = await asyncio.gather(*(self._wait_ready(worker) for worker in self.workers))
+            self.startup = {
+                'workers_warm': sum(warm),
+                'ready_after_ms': (time.perf_counter() - started) * 1000
+            }
+            logger.info(
+                f"Moderation workers ready in {self.startup['ready_after_ms']:.0f}ms "
+                f"({self.startup['workers_warm']}/{len(self.workers)} workers)."
+            )
+        finally:
+            self.ready.set()
+            if self._supervisor is None and not self.closed:
+                self._supervisor = asyncio.create_task(self._supervise())
+
+    async def _start(self, worker: WorkerHandle) -> None:
+        try:
+            await worker.start(self.connect_timeout)
+            logger.info(f"Started moderation worker {worker.index} (pid {worker.process.pid}).")
+        except Exception as e:
+            logger.error(f"Failed to start moderation worker {worker.index}: {e}")
+            await worker.stop()
+
+    async def _wait_ready(self, worker: WorkerHandle) -> bool:
+        deadline = time.monotonic() + self.connect_timeout
+        while worker.alive and time.monotonic() < deadline:
+            try:
+                response = await worker.request({'op': 'ping', 'id': next(self._ids)}, self.health_timeout)
+                if response.get('ready'):
+                    return True
+            except Exception:
+                pass
+            await asyncio.sleep(0.5)
+        return False
+
+    async def _supervise(self) -> None:
+        while not self.closed:
+            await asyncio.sleep(self.health_interval)
+            await asyncio.gather(*(self._check_health(worker) for worker in self.workers))
+
+    async def _check_health(self, worker: WorkerHandle) -> None:
+        if worker.alive:
+            try:
+                await worker.request({'op': 'ping', 'id': next(self._ids)}, self.health_timeout)
+                return
+            except Exception as e:
+                logger.warning(f"Moderation worker {worker.index} failed its health check: {e}")
+        else:
+            code = worker.process.returncode if worker.process else None
+            logger.warning(f"Moderation worker {worker.index} is down (exit code {code}), restarting it.")
+
+        await worker.stop()
+        worker.restarts += 1
+        await self._start(worker)
+
+    def _pick(self) -> Optional[WorkerHandle]:
+        alive = [worker for worker in self.workers if worker.alive]
+        return min(alive, key=lambda worker: len(worker.pending)) if alive else None
+
+    async def scan_message(self, message: discord.Message, attachments: AttachmentBundle) -> ScanResult:
+        """Scan on the least busy worker, which reads the files the bot already downloaded"""
+        # Whatever a failed job should have scanned is left out of the relay
+        scannable = [
+            index for index, attachment in enumerate(attachments.attachments)
+            if scan_kind(attachment.content_type, attachment.filename)
+        ]
+        if not scannable:
+            return ScanResult()
+
+        worker = self._pick()
+        if worker is None:
+            logger.error(f"No moderation worker available, attachments of message {message.id} are not relayed.")
+            return ScanResult(content_type="unavailable", unscanned=scannable)
+
+        loop = asyncio.get_running_loop()
+        records, written = await loop.run_in_executor(None, share_attachments, attachments)
+        payload = {
+            'op': 'scan',
+            'id': next(self._ids),
+            'deadline': self.job_deadline,
+            'source': scan_source(message),
+            'attachments': records
+        }
+        worker.jobs += 1
+        try:
+            # A little grace over the job deadline so the worker's own timeout answers first
+            response = await worker.request(payload, self.job_deadline + 1)
+        except asyncio.TimeoutError:
+            worker.timeouts += 1
+            logger.error(f"Moderation worker {worker.index} missed the deadline for message {message.id}.")
+            return ScanResult(content_type="timeout", unscanned=scannable)
+        except Exception as e:
+            worker.failures += 1
+            logger.error(f"Moderation worker {worker.index} failed to scan message {message.id}: {e}")
+            return ScanResult(content_type="error", unscanned=scannable)
+        finally:
+            await loop.run_in_executor(None, remove_files, written)
+
+        if not response.get('ok'):
+            worker.failures += 1
+            logger.error(f"Moderation worker {worker.index} could not scan message {message.id}: {response.get('error')}")
+            return ScanResult(content_type="error", unscanned=scannable)
+        return ScanResult.from_dict(response['result'])
+
+    async def forget_hash(self, hex_hash: str, cleared_by: Optional[int] = None) -> bool:
+        """Every worker keeps its own copy of the stored hashes, so each one is told to drop it"""
+        payload = {'op': 'forget', 'hash': hex_hash, 'cleared_by': cleared_by}
+        forgotten = False
+        for worker in self.workers:
+            if not worker.alive:
+                continue
+            try:
+                response = await worker.request({**payload, 'id': next(self._ids)}, self.health_timeout)
+            except Exception as e:
+                logger.error(f"Moderation worker {worker.index} did not clear NSFW hash {hex_hash}: {e}")
+                continue
+            forgotten = forgotten or bool(response.get('forgotten'))
+        return forgotten
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **super().stats(),
+            'workers': [
+                {
+                    'index': worker.index,
+                    'pid': worker.process.pid if worker.process else None,
+                    'alive': worker.alive,
+                    'inflight': len(worker.pending),
+                    'jobs': worker.jobs,
+                    'timeouts': worker.timeouts,
+                    'failures': worker.failures,
+                    'restarts': worker.restarts
+                }
+                for worker in self.workers
+            ]
+        }
+
+    async def collect_stats(self) -> Dict[str, Any]:
+        """stats() plus each live worker's own scanner stats, asked for over its socket"""
+        stats = self.stats()
+        replies = await asyncio.gather(*(self._worker_stats(worker) for worker in self.workers))
+        for entry, reply in zip(stats['workers'], replies):
+            entry['scanner'] = reply
+        return stats
+
+    async def _worker_stats(self, worker: WorkerHandle) -> Optional[Dict[str, Any]]:
+        if not worker.alive:
+            return None
+        try:
+            response = await worker.request({'op': 'stats', 'id': next(self._ids)}, self.health_timeout)
+        except Exception as e:
+            logger.warning(f"Moderation worker {worker.index} did not answer a stats request: {e}")
+            return None
+        return response.get('stats') if response.get('ok') else None
+
+    async def cleanup(self):
+        self.closed = True
+        if self._supervisor and not self._supervisor.done():
+            self._supervisor.cancel()
+            try:
+                await self._supervisor
+            except asyncio.CancelledError:
+                pass
+
+        await asyncio.gather(*(worker.stop() for worker in self.workers))
+        shutil.rmtree(self.socket_dir, ignore_errors=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Beaniverse moderation worker")
+    parser.add_argument('--socket', required=True, help="Unix socket path to listen on")
+    parser.add_argument('--parent-pid', type=int, help="Exit when this process is no longer the parent")
+    parser.add_argument('--pool-size', type=int, help="Inference processes, one per core by default")
+    args = parser.parse_args()
+
+    load_dotenv()
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - moderation worker %(process)d - %(name)s - %(levelname)s - %(message)s'
+    )
+    asyncio.run(run_worker(args.socket, args.parent_pid, args.pool_size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, Optional, Tuple
+
+import discord
+from pymongo import DeleteOne, UpdateOne
+
+from events.database import AsyncCollection
+
+logger = logging.getLogger(__name__)
+
+
+class MuteEntry:
+    __slots__ = ('user_id', 'end_time', 'reason', 'mute_message', 'channel_id', 'seq', 'muted_at')
+
+    def __init__(self, user_id: int, end_time: Optional[datetime], reason: str,
+                 mute_message: Optional[discord.Message], channel_id: int, seq: int,
+                 muted_at: Optional[datetime] = None):
+        self.user_id = user_id
+        self.muted_at = muted_at or datetime.now(timezone.utc)
+        # None means the mute never expires on its own
+        self.end_time = end_time
+        self.reason = reason
+        self.mute_message = mute_message
+        self.channel_id = channel_id
+        self.seq = seq
+
+    @property
+    def permanent(self) -> bool:
+        return self.end_time is None
+
+    def active(self, now: datetime) -> bool:
+        return self.end_time is None or now < self.end_time
+
+
+class MuteStore:
+    """Active mutes in their own collection, writes coalesced per user and flushed with bulk_write"""
+
+    def __init__(self, collection: AsyncCollection, flush_interval: float = 1.0):
+        self.collection = collection
+        self.flush_interval = flush_interval
+        # Latest state per user waiting to be written, None marks a delete
+        self.pending: Dict[int, Optional[MuteEntry]] = {}
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.written = 0
+
+    async def setup_indexes(self) -> None:
+        await self.collection.create_index("user_id", unique=True)
+        # Documents without expires_at (permanent mutes) are never removed by the TTL monitor
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    async def load(self) -> List[Mapping[str, Any]]:
+        """Every mute still active, in a single query"""
+        now = datetime.now(timezone.utc)
+        return await self.collection.find({
+            '$or': [
+                {'expires_at': {'$exists': False}},
+                {'expires_at': {'$gt': now}}
+            ]
+        })
+
+    def save(self, entry: MuteEntry) -> None:
+        self.pending[entry.user_id] = entry
+
+    def delete(self, user_id: int) -> None:
+        self.pending[user_id] = None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await asyncio.shield(self.flush())
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self.pending:
+                return
+
+            pending, self.pending = self.pending, {}
+            operations = []
+            for user_id, entry in pending.items():
+                if entry is None:
+                    operations.append(DeleteOne({'user_id': user_id}))
+                    continue
+
+                document = {
+                    'user_id': user_id,
+                    'reason': entry.reason,
+                    'channel_id': entry.channel_id,
+                    'muted_at': entry.muted_at
+                }
+                update: Dict[str, Any] = {'$set': document}
+                if entry.end_time is None:
+                    update['$unset'] = {'expires_at': ''}
+                else:
+                    document['expires_at'] = entry.end_time
+                operations.append(UpdateOne({'user_id': user_id}, update, upsert=True))
+
+            try:
+                await self.collection.bulk_write(operations, ordered=False)
+                self.written += len(operations)
+            except Exception as e:
+                logger.error(f"Failed to persist {len(operations)} mute changes: {e}")
+                # Keep anything that changed again meanwhile, retry the rest on the next flush
+                for user_id, entry in pending.items():
+                    self.pending.setdefault(user_id, entry)
+
+    async def close(self) -> None:
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+
+class MuteScheduler:
+    """Active mutes on a min-heap of expiry times, a single task sleeps until the earliest one"""
+
+    def __init__(self, on_expire: Callable[[MuteEntry], Awaitable[None]], store: Optional[MuteStore] = None):
+        self.on_expire = on_expire
+        self.store = store
+        self.entries: Dict[int, MuteEntry] = {}
+        self._heap: List[Tuple[float, int, int]] = []
+        self._seq = itertools.count()
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, user_id: int) -> Optional[MuteEntry]:
+        entry = self.entries.get(user_id)
+        if entry and not entry.active(datetime.now(timezone.utc)):
+            # Expired but the scheduler has not woken up for it yet
+            return None
+        return entry
+
+    def schedule(self, user_id: int, end_time: Optional[datetime], reason: str,
+                 mute_message: Optional[discord.Message], channel_id: int,
+                 muted_at: Optional[datetime] = None, persist: bool = True) -> MuteEntry:
+        """Add a mute, or replace the user's current one so a re-mute never leaves two pending expiries"""
+        entry = MuteEntry(user_id, end_time, reason, mute_message, channel_id, next(self._seq), muted_at)
+        self.entries[user_id] = entry
+        if persist and self.store:
+            self.store.save(entry)
+
+        if end_time is not None:
+            deadline = end_time.timestamp()
+            if not self._heap or deadline < self._heap[0][0]:
+                self._changed.set()
+            heapq.heappush(self._heap, (deadline, entry.seq, user_id))
+            self._compact()
+        return entry
+
+    def cancel(self, user_id: int) -> Optional[MuteEntry]:
+        entry = self.entries.pop(user_id, None)
+        if entry and self.store:
+            self.store.delete(user_id)
+        self._compact()
+        return entry
+
+    def restore(self, documents: List[Mapping[str, Any]]) -> int:
+        """Rehydrate mutes loaded from the store without writing them back"""
+        for document in documents:
+            end_time = document.get('expires_at')
+            if end_time is not None and end_time.tzinfo is None:
+                end_time = end_time.replace(tzinfo=timezone.utc)
+            muted_at = document.get('muted_at')
+            if muted_at is not None and muted_at.tzinfo is None:
+                muted_at = muted_at.replace(tzinfo=timezone.utc)
+            self.schedule(
+                int(document['user_id']),
+                end_time,
+                document.get('reason', ''),
+                None,
+                int(document.get('channel_id', 0)),
+                muted_at=muted_at,
+                persist=False
+            )
+        return len(documents)
+
+    def _is_current(self, seq: int, user_id: int) -> bool:
+        entry = self.entries.get(user_id)
+        return entry is not None and entry.seq == seq
+
+    def _compact(self) -> None:
+        # Superseded heap items are skipped lazily, rebuild once they outnumber the live ones
+        if len(self._heap) > 2 * len(self.entries) + 16:
+            self._heap = [item for item in self._heap if self._is_current(item[1], item[2])]
+            heapq.heapify(self._heap)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self) -> None:
+        while True:
+            self._changed.clear()
+            now = datetime.now(timezone.utc).timestamp()
+
+            while self._heap and self._heap[0][0] <= now:
+                _, seq, user_id = heapq.heappop(self._heap)
+                if self._is_current(seq, user_id):
+                    entry = self.entries.pop(user_id)
+                    asyncio.create_task(self._expire(entry))
+
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _expire(self, entry: MuteEntry) -> None:
+        try:
+            await self.on_expire(entry)
+        except Exception as e:
+            logger.error(f"Error handling mute expiration for user {entry.user_id}: {e}")
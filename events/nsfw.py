@@ -1,142 +1,811 @@
 import discord
-from discord.ext import commands
-import aiohttp
-import tempfile
+import hashlib
 import os
-from nudenet import NudeDetector
 import logging
-from typing import Optional, Tuple
+import math
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
-from PIL import Image
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import io
+from PIL import Image, ImageOps
+
+from events.attachments import TMPFS_DIR, AttachmentBundle, SharedAttachment
+from events.database import AsyncCollection
+from events.phash import HashIndex, VerdictCache, dhash_image, informative, to_hex
 
 logger = logging.getLogger(__name__)
 
-class NSFWDetector:
-    def __init__(self):
-        self.detector = NudeDetector()
-        
-        self.executor = ThreadPoolExecutor(max_workers=2)
-        
-        self.NSFW_THRESHOLD = 0.7  
-        self.ALLOWED_FORMATS = {
-            'image': ['.jpg', '.jpeg', '.png', '.webp'],
-            'video': ['.mp4', '.mov', '.webm']
-        }
+# Detector classes that make an image NSFW, covered parts and faces are not a reason to block
+EXPLICIT_LABELS = frozenset({
+    'FEMALE_BREAST_EXPOSED',
+    'FEMALE_GENITALIA_EXPOSED',
+    'MALE_GENITALIA_EXPOSED',
+    'BUTTOCKS_EXPOSED',
+    'ANUS_EXPOSED'
+})
+
+# OpenCV can only demux video from a path, videos held in memory are written to tmpfs for the scan
+VIDEO_SPOOL_DIR = TMPFS_DIR
+
+# One NudeDetector per worker process, loaded by the pool initializer
+_detector = None
+_load_ms = 0.0
+
+UNREADY_POLICIES = ('hold', 'allow')
+
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.webm')
+
+
+def scan_kind(content_type: Optional[str], filename: str) -> Optional[str]:
+    """'image' or 'video' for attachments the detector scores, None for anything it passes through"""
+    content_type = content_type or ''
+    if content_type.startswith('image/'):
+        return 'image'
+    if content_type.startswith('video/') or os.path.splitext(filename)[1].lower() in VIDEO_EXTENSIONS:
+        return 'video'
+    return None
+
+
+def available_cpus() -> int:
+    """Cores this process may run on, unlike os.cpu_count() this respects CPU affinity and container cpusets"""
+    try:
+        return len(os.sched_getaffinity(0)) or 1
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def content_digest(data: bytes) -> bytes:
+    return hashlib.sha256(data).digest()
+
+
+def _init_worker() -> None:
+    global _detector, _load_ms
+    started = time.perf_counter()
+    import cv2
+    import nudenet
+    import onnxruntime
+    from nudenet import NudeDetector
+
+    # The pool already runs one process per core. nudenet's default session would add a thread per core
+    # in every one of them, so each process scores on a single thread instead.
+    cv2.setNumThreads(1)
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = 1
+    options.inter_op_num_threads = 1
+    _detector = NudeDetector()
+    _detector.onnx_session = onnxruntime.InferenceSession(
+        os.path.join(os.path.dirname(nudenet.__file__), '320n.onnx'),
+        sess_options=options,
+        providers=['CPUExecutionProvider']
+    )
+    _load_ms = (time.perf_counter() - started) * 1000
+
+
+def _warm_up(data: bytes) -> Tuple[int, float, float]:
+    """First inference of a worker, returns (pid, model load ms, inference ms)"""
+    started = time.perf_counter()
+    _detect_batch([data])
+    return os.getpid(), _load_ms, (time.perf_counter() - started) * 1000
+
+
+def _score(detections: List[dict]) -> float:
+    return max((pred['score'] for pred in detections if pred['class'] in EXPLICIT_LABELS), default=0.0)
+
+
+def _detect_batch(images: List[bytes]) -> List[Optional[float]]:
+    """Score a batch of encoded images in one model call, None for the ones that do not decode"""
+    import cv2
+    import numpy as np
+
+    decoded = [cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR) for data in images]
+    valid = [image for image in decoded if image is not None]
+    detections = iter(_detector.detect_batch(valid, batch_size=len(valid)) if valid else ())
+    return [None if image is None else _score(next(detections)) for image in decoded]
+
+
+def _sample_times(duration: float, max_frames: int) -> List[float]:
+    """Evenly spread sample points, about one every two seconds for short clips and max_frames for long ones"""
+    count = max(1, min(max_frames, math.ceil(duration / 2)))
+    return [(index + 0.5) * duration / count for index in range(count)]
+
+
+def _scan_video(video: Union[bytes, str], suffix: str, threshold: float, ratio: float, max_frames: int,
+                max_seconds: float, batch_size: int) -> Tuple[bool, float]:
+    """Score a video given as bytes or as the path of a file it is already spooled to"""
+    if isinstance(video, str):
+        return _scan_video_file(video, threshold, ratio, max_frames, max_seconds, batch_size)
+
+    with tempfile.NamedTemporaryFile(suffix=suffix, dir=VIDEO_SPOOL_DIR) as spool:
+        spool.write(video)
+        spool.flush()
+        return _scan_video_file(spool.name, threshold, ratio, max_frames, max_seconds, batch_size)
+
+
+def _scan_video_file(path: str, threshold: float, ratio: float, max_frames: int,
+                     max_seconds: float, batch_size: int) -> Tuple[bool, float]:
+    """Score sampled frames of a video in batches, stopping once the verdict can no longer change"""
+    import cv2
+
+    deadline = time.monotonic() + max_seconds
+    capture = cv2.VideoCapture(path)
+    try:
+        if not capture.isOpened():
+            raise ValueError("Undecodable video")
+
+        fps = capture.get(cv2.CAP_PROP_FPS) or 0.0
+        frame_count = capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0.0
+        if fps > 0 and frame_count > 0:
+            positions = [int(t * fps) for t in _sample_times(frame_count / fps, max_frames)]
+        else:
+            # No usable header (some webm streams), sample the first frames sequentially instead
+            positions = list(range(0, max_frames * 30, 30))
+        planned = len(positions)
+
+        nsfw_frames = scored = 0
+        batch = []
+        for index, position in enumerate(positions):
+            if time.monotonic() > deadline:
+                # The early exit below has not settled the verdict, unscored frames must not count as safe
+                raise TimeoutError(f"Time budget ran out after scoring {scored} of {planned} frames")
+            capture.set(cv2.CAP_PROP_POS_FRAMES, position)
+            ok, frame = capture.read()
+            if ok:
+                batch.append(frame)
+            else:
+                planned -= 1
+            if not batch or (len(batch) < batch_size and index < len(positions) - 1):
+                continue
+
+            nsfw_frames += sum(
+                _score(detections) >= threshold
+                for detections in _detector.detect_batch(batch, batch_size=len(batch))
+            )
+            scored += len(batch)
+            batch = []
+
+            # Early exit both ways: already over the ratio, or too few frames left to get there
+            if nsfw_frames >= ratio * planned or nsfw_frames + (planned - scored) < ratio * planned:
+                break
+    finally:
+        capture.release()
 
-        self.session = aiohttp.ClientSession()
+    if scored == 0:
+        raise ValueError("No frame of the video could be scored")
+    nsfw_ratio = min(1.0, nsfw_frames / planned)
+    return nsfw_ratio >= ratio, nsfw_ratio
 
-    async def download_file(self, url: str) -> Optional[str]:
+
+class WorkerPool:
+    """The spawned inference processes, replaced with a fresh pool when a dying worker breaks it"""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.executor = self._spawn()
+        self.rebuilds = 0
+        # Set by the first warm-up, a rebuilt pool is warmed up on it again
+        self.warm_sample: Optional[bytes] = None
+        self._warming: Optional[asyncio.Task] = None
+
+    def _spawn(self) -> ProcessPoolExecutor:
+        # Spawned rather than forked, the bot process has live threads and sockets by now.
+        # Workers start, and load the model, on the first job, normally the warm-up after login.
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker
+        )
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        executor = self.executor
+        try:
+            return await loop.run_in_executor(executor, func, *args)
+        except BrokenProcessPool:
+            self._rebuild(executor)
+            # Once more on the new pool, a job that kills its worker by itself then fails on its own
+            return await loop.run_in_executor(self.executor, func, *args)
+
+    def _rebuild(self, broken: ProcessPoolExecutor) -> None:
+        if self.executor is not broken:
+            # Another job caught in the same crash already replaced it
+            return
+        logger.error("An NSFW worker process died, starting a new pool.")
+        broken.shutdown(wait=False, cancel_futures=True)
+        self.executor = self._spawn()
+        self.rebuilds += 1
+        if self.warm_sample is not None:
+            self._warming = asyncio.create_task(self._rewarm())
+
+    async def _rewarm(self) -> None:
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    if response.status != 200:
-                        return None
-                    
-                    extension = os.path.splitext(url)[1].lower()
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=extension) as tmp_file:
-                        tmp_file.write(await response.read())
-                        return tmp_file.name
+            results = await self.warm_up(self.warm_sample)
+            logger.info(f"New NSFW worker pool warm, {len({pid for pid, _, _ in results})}/{self.workers} workers.")
         except Exception as e:
-            logger.error(f"Error downloading file: {e}")
+            logger.error(f"Warming up the new NSFW worker pool failed: {e}")
+
+    async def warm_up(self, sample: bytes) -> List[Tuple[int, float, float]]:
+        """One inference on every worker, each returns (pid, model load ms, inference ms)"""
+        self.warm_sample = sample
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*(
+            loop.run_in_executor(self.executor, _warm_up, sample)
+            for _ in range(self.workers)
+        ))
+
+    def shutdown(self) -> None:
+        if self._warming and not self._warming.done():
+            self._warming.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class InferenceBatcher:
+    """Gathers images for up to max_wait seconds or max_batch of them, then scores them in one worker call"""
+
+    def __init__(self, pool: WorkerPool, max_batch: int = 8, max_wait: float = 0.005):
+        self.pool = pool
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+        self.pending: List[Tuple[bytes, asyncio.Future, float]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._inflight: Set[asyncio.Task] = set()
+
+        self.batches = 0
+        self.images = 0
+        self.batch_sizes: Dict[int, int] = {}
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+
+    async def submit(self, data: bytes) -> float:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((data, future, time.perf_counter()))
+
+        if len(self.pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+        if self.pending:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush)
+        if not batch:
+            return
+
+        now = time.perf_counter()
+        for _, _, queued in batch:
+            waited = (now - queued) * 1000
+            self.total_wait_ms += waited
+            self.max_wait_ms = max(self.max_wait_ms, waited)
+        self.batches += 1
+        self.images += len(batch)
+        self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+
+        task = asyncio.create_task(self._run(batch))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+
+    async def _run(self, batch: List[Tuple[bytes, asyncio.Future, float]]) -> None:
+        try:
+            scores = await self.pool.run(_detect_batch, [data for data, _, _ in batch])
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future, _), score in zip(batch, scores):
+            if future.done():
+                # The caller gave up waiting
+                continue
+            if score is None:
+                future.set_exception(ValueError("Undecodable image"))
+            else:
+                future.set_result(score)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'queued': len(self.pending),
+            'inflight_batches': len(self._inflight),
+            'batches': self.batches,
+            'images': self.images,
+            'avg_batch_size': self.images / self.batches if self.batches else 0.0,
+            'batch_sizes': dict(sorted(self.batch_sizes.items())),
+            'avg_queue_wait_ms': self.total_wait_ms / self.images if self.images else 0.0,
+            'max_queue_wait_ms': self.max_wait_ms
+        }
+
+    async def close(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for _, future, _ in self.pending:
+            if not future.done():
+                future.cancel()
+        self.pending = []
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+
+
+class PreparedImage:
+    __slots__ = ('hash', 'thumbnail')
+
+    def __init__(self, image_hash: int, thumbnail: bytes):
+        self.hash = image_hash
+        # Uncompressed BMP, the workers decode it without any inflate or IDCT work
+        self.thumbnail = thumbnail
+
+
+class OversizedImage(ValueError):
+    """An image whose header announces more pixels than the preprocessor will decode"""
+
+
+class ImagePreprocessor:
+    """Pillow stage in front of inference: header-only size gate, reduced decode and a model-sized thumbnail"""
+
+    @classmethod
+    def from_env(cls) -> 'ImagePreprocessor':
+        return cls(
+            max_pixels=int(os.getenv('NSFW_MAX_IMAGE_PIXELS', '50000000')),
+            forward_budget=int(os.getenv('FORWARD_IMAGE_BUDGET', '0'))
+        )
+
+    def __init__(self, max_pixels: int = 50_000_000, model_size: int = 320, forward_budget: int = 0,
+                 forward_max_side: int = 2048, forward_quality: int = 85):
+        self.max_pixels = max_pixels
+        self.model_size = model_size
+        # 0 turns recompression for forwarding off
+        self.forward_budget = forward_budget
+        self.forward_max_side = forward_max_side
+        self.forward_quality = forward_quality
+
+        # Scan and forwarding counters are kept apart, every forwarded image was already counted by its scan
+        self.prepared = 0
+        self.oversized = 0
+        self.undecodable = 0
+        self.forward_shrunk = 0
+        self.forward_oversized = 0
+        self.forward_undecodable = 0
+        self.forward_saved_bytes = 0
+
+    def _open(self, source: Union[bytes, str]) -> Image.Image:
+        """Open an image from bytes or a path, reading only its header, OversizedImage past max_pixels"""
+        image = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+        width, height = image.size
+        if width * height > self.max_pixels:
+            image.close()
+            raise OversizedImage(f"{width}x{height} image, over the {self.max_pixels} pixel limit")
+        return image
+
+    def prepare(self, data: bytes) -> Optional[PreparedImage]:
+        """Perceptual hash and model-sized thumbnail of an image, None if it is too large or undecodable"""
+        try:
+            image = self._open(data)
+        except OversizedImage as e:
+            self.oversized += 1
+            logger.warning(f"Not scanning {e}.")
+            return None
+        except Exception:
+            self.undecodable += 1
             return None
 
-    def analyze_image(self, file_path: str) -> Tuple[bool, float]:
         try:
-            result = self.detector.detect(file_path)
+            with image:
+                # JPEGs are decoded at the smallest DCT scale that still covers the model input
+                image.draft('RGB', (self.model_size, self.model_size))
+                image = ImageOps.exif_transpose(image).convert('RGB')
+                image.thumbnail((self.model_size, self.model_size), Image.Resampling.BILINEAR)
 
-            if not result:
-                return False, 0.0
-            
-            nsfw_score = max((pred['score'] for pred in result), default=0.0)
-            return nsfw_score >= self.NSFW_THRESHOLD, nsfw_score
+                buffer = io.BytesIO()
+                image.save(buffer, format='BMP')
+                self.prepared += 1
+                return PreparedImage(dhash_image(image), buffer.getvalue())
         except Exception as e:
-            logger.error(f"Error analyzing image: {e}")
-            return False, 0.0
+            self.undecodable += 1
+            logger.error(f"Error preprocessing image: {e}")
+            return None
+
+    def shrink_for_forwarding(self, source: Union[bytes, str], size: int, filename: str) -> Optional[Tuple[bytes, str]]:
+        """Downscaled, recompressed copy of an image over the forwarding budget, None to send the original"""
+        # Decided on the size alone, a spooled image is only opened when it is actually shrunk
+        if not self.forward_budget or size <= self.forward_budget:
+            return None
+
+        try:
+            image = self._open(source)
+        except OversizedImage:
+            self.forward_oversized += 1
+            return None
+        except Exception:
+            self.forward_undecodable += 1
+            return None
 
-    def analyze_video(self, file_path: str) -> Tuple[bool, float]:
         try:
-            results = self.video_detector.detect_video(file_path)
-
-            if not results:
-                return False, 0.0
-                
-            nsfw_frames = sum(1 for frame in results if frame['score'] >= self.NSFW_THRESHOLD)
-            nsfw_percentage = nsfw_frames / len(results)
-            
-            return nsfw_percentage >= 0.3, nsfw_percentage  
+            with image:
+                if getattr(image, 'is_animated', False):
+                    return None
+
+                image.draft('RGB', (self.forward_max_side, self.forward_max_side))
+                image = ImageOps.exif_transpose(image)
+                image.thumbnail((self.forward_max_side, self.forward_max_side), Image.Resampling.LANCZOS)
+
+                buffer = io.BytesIO()
+                stem = os.path.splitext(filename)[0]
+                if image.mode in ('RGBA', 'LA', 'P'):
+                    image.save(buffer, format='PNG', optimize=True)
+                    shrunk, shrunk_name = buffer.getvalue(), f"{stem}.png"
+                else:
+                    image.convert('RGB').save(buffer, format='JPEG', quality=self.forward_quality, optimize=True)
+                    shrunk, shrunk_name = buffer.getvalue(), f"{stem}.jpg"
         except Exception as e:
-            logger.error(f"Error analyzing video: {e}")
-            return False, 0.0
-
-    async def analyze_attachment(self, attachment: discord.Attachment) -> Tuple[bool, float, str]:
-        file_ext = os.path.splitext(attachment.filename)[1].lower()
-        
-        if file_ext in self.ALLOWED_FORMATS['image']:
-            content_type = 'image'
-        elif file_ext in self.ALLOWED_FORMATS['video']:
-            content_type = 'video'
-        else:
-            return False, 0.0, "Unsupported format"
+            logger.error(f"Error recompressing {filename} for forwarding: {e}")
+            return None
+
+        if len(shrunk) >= size:
+            return None
+        self.forward_shrunk += 1
+        self.forward_saved_bytes += size - len(shrunk)
+        return shrunk, shrunk_name
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'prepared': self.prepared,
+            'oversized': self.oversized,
+            'undecodable': self.undecodable,
+            'forward_shrunk': self.forward_shrunk,
+            'forward_oversized': self.forward_oversized,
+            'forward_undecodable': self.forward_undecodable,
+            'forward_saved_bytes': self.forward_saved_bytes
+        }
+
+
+def scan_source(message: discord.Message) -> Dict[str, Any]:
+    """Where a scanned attachment came from, stored with any hash it adds to nsfw_hashes"""
+    return {
+        'message_id': message.id,
+        'user_id': message.author.id,
+        'channel_id': message.channel.id,
+        'guild_id': message.guild.id if message.guild else None
+    }
+
+
+class ScanResult:
+    """Verdict for one attachment, or the deciding one for a whole message"""
+
+    __slots__ = ('is_nsfw', 'score', 'content_type', 'known_hash', 'unscanned')
+
+    def __init__(self, is_nsfw: bool = False, score: float = 0.0, content_type: str = 'safe',
+                 known_hash: Optional[str] = None, unscanned: Optional[List[int]] = None):
+        self.is_nsfw = is_nsfw
+        self.score = score
+        self.content_type = content_type
+        # Set when the verdict came from a stored NSFW hash rather than from the model
+        self.known_hash = known_hash
+        # Bundle positions of attachments that could not be scanned, they must not be relayed
+        self.unscanned = unscanned or []
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'ScanResult':
+        return cls(bool(data['is_nsfw']), float(data['score']), data['content_type'], data.get('known_hash'),
+                   data.get('unscanned'))
+
+    @classmethod
+    def merge(cls, results: Iterable['ScanResult']) -> 'ScanResult':
+        """A fresh model verdict outranks a stored hash match, which outranks a clean result"""
+        flagged = [result for result in results if result.is_nsfw]
+        fresh = [result for result in flagged if result.known_hash is None]
+        if fresh:
+            return max(fresh, key=lambda result: result.score)
+        return flagged[0] if flagged else cls()
+
+
+class DetectorBase:
+    """What both scanning backends share: size limits, the unready policy and the gate in front of every scan"""
+
+    @staticmethod
+    def settings_from_env() -> Dict[str, Any]:
+        return {
+            'max_image_bytes': int(os.getenv('NSFW_MAX_IMAGE_BYTES', str(20 * 1024 * 1024))),
+            'max_video_bytes': int(os.getenv('NSFW_MAX_VIDEO_BYTES', str(100 * 1024 * 1024))),
+            'preprocessor': ImagePreprocessor.from_env(),
+            'unready_policy': os.getenv('NSFW_UNREADY_POLICY', 'hold').lower()
+        }
+
+    def __init__(self, max_image_bytes: int = 20 * 1024 * 1024, max_video_bytes: int = 100 * 1024 * 1024,
+                 preprocessor: Optional[ImagePreprocessor] = None, unready_policy: str = 'hold'):
+        self.max_image_bytes = max_image_bytes
+        self.max_video_bytes = max_video_bytes
+        self.preprocessor = preprocessor or ImagePreprocessor()
+
+        if unready_policy not in UNREADY_POLICIES:
+            logger.warning(f"Unknown NSFW unready policy '{unready_policy}', holding attachments instead.")
+            unready_policy = 'hold'
+        self.unready_policy = unready_policy
+        self.ready = asyncio.Event()
+        self.skipped_unready = 0
+        self.startup: Dict[str, float] = {}
+
+    def download_limit(self, attachment: discord.Attachment) -> Optional[int]:
+        """Largest image or video that is scanned, and so relayed, None for files that are not scanned"""
+        kind = scan_kind(attachment.content_type, attachment.filename)
+        if kind is None:
+            return None
+        return self.max_image_bytes if kind == 'image' else self.max_video_bytes
+
+    async def check_message(self, message: discord.Message, attachments: AttachmentBundle) -> ScanResult:
+        if not self.ready.is_set():
+            if self.unready_policy == 'allow':
+                self.skipped_unready += 1
+                return ScanResult()
+            await self.ready.wait()
+
+        return await self.scan_message(message, attachments)
+
+    async def scan_message(self, message: discord.Message, attachments: AttachmentBundle) -> ScanResult:
+        """The backend's own scan of a message's downloaded attachments"""
+        raise NotImplementedError
 
-        temp_path = await self.download_file(attachment.url)
-        if not temp_path:
-            return False, 0.0, "Download failed"
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.preprocessor.stats(),
+            **self.startup,
+            'ready': self.ready.is_set(),
+            'skipped_unready': self.skipped_unready
+        }
+
+
+class NSFWDetector(DetectorBase):
+    @classmethod
+    def from_env(cls, hashes: Optional[AsyncCollection] = None, workers: Optional[int] = None) -> 'NSFWDetector':
+        return cls(
+            workers=workers,
+            batch_size=int(os.getenv('NSFW_BATCH_SIZE', '8')),
+            batch_wait=float(os.getenv('NSFW_BATCH_MAX_WAIT_MS', '5')) / 1000,
+            hashes=hashes,
+            hash_distance=int(os.getenv('NSFW_HASH_DISTANCE', '4')),
+            hash_min_score=float(os.getenv('NSFW_HASH_MIN_SCORE', '0.9')),
+            cache_size=int(os.getenv('NSFW_VERDICT_CACHE_SIZE', '10000')),
+            cache_ttl=float(os.getenv('NSFW_VERDICT_CACHE_TTL', '3600')),
+            video_max_frames=int(os.getenv('NSFW_VIDEO_MAX_FRAMES', '32')),
+            video_max_seconds=float(os.getenv('NSFW_VIDEO_MAX_SECONDS', '15')),
+            **cls.settings_from_env()
+        )
+
+    def __init__(self, workers: Optional[int] = None, batch_size: int = 8, batch_wait: float = 0.005,
+                 hashes: Optional[AsyncCollection] = None, hash_distance: int = 4, hash_min_score: float = 0.9,
+                 cache_size: int = 10000, cache_ttl: float = 3600,
+                 max_image_bytes: int = 20 * 1024 * 1024, max_video_bytes: int = 100 * 1024 * 1024,
+                 video_max_frames: int = 32, video_max_seconds: float = 15,
+                 preprocessor: Optional[ImagePreprocessor] = None, unready_policy: str = 'hold'):
+        super().__init__(max_image_bytes, max_video_bytes, preprocessor, unready_policy)
+        self.workers = workers or available_cpus()
+        self.pool = WorkerPool(self.workers)
+        self.batcher = InferenceBatcher(self.pool, batch_size, batch_wait)
+
+        # Verdicts for recently seen images by content digest, and images the model was very sure about
+        # matched by near-duplicate. Hashes a moderator cleared are neither matched nor stored again.
+        self.hashes = hashes
+        self.hash_min_score = hash_min_score
+        self.verdicts: VerdictCache[Tuple[bool, float, int]] = VerdictCache(cache_size, cache_ttl)
+        self.known_bad: HashIndex[float] = HashIndex(hash_distance)
+        self.cleared: Set[int] = set()
+        self.known_bad_hits = 0
 
+        self.NSFW_THRESHOLD = 0.7
+        # Share of sampled frames that must be NSFW for the whole video to be
+        self.VIDEO_NSFW_RATIO = 0.3
+        self.video_max_frames = video_max_frames
+        self.video_max_seconds = video_max_seconds
+        self.ALLOWED_FORMATS = {
+            'image': ['.jpg', '.jpeg', '.png', '.webp'],
+            'video': list(VIDEO_EXTENSIONS)
+        }
+
+    async def warm_up(self, sample_path: str) -> None:
+        """Start every worker and run one inference on the bundled sample, then mark the detector ready"""
+        started = time.perf_counter()
         try:
-            if content_type == 'image':
-                is_nsfw, score = await asyncio.get_event_loop().run_in_executor(
-                    self.executor,
-                    self.analyze_image,
-                    temp_path
-                )
-            else:
-                is_nsfw, score = await asyncio.get_event_loop().run_in_executor(
-                    self.executor,
-                    self.analyze_video,
-                    temp_path
-                )
+            with open(sample_path, 'rb') as f:
+                sample = f.read()
+            prepared = self.preprocessor.prepare(sample)
+            if prepared is None:
+                raise ValueError(f"Warm-up sample {sample_path} is not a usable image")
 
-            return is_nsfw, score, content_type
+            results = await self.pool.warm_up(prepared.thumbnail)
+            self.startup = {
+                'workers_warm': len({pid for pid, _, _ in results}),
+                'model_load_ms': max(load_ms for _, load_ms, _ in results),
+                'warm_up_ms': max(infer_ms for _, _, infer_ms in results),
+                'ready_after_ms': (time.perf_counter() - started) * 1000
+            }
+            logger.info(
+                f"NSFW detector ready in {self.startup['ready_after_ms']:.0f}ms "
+                f"(model load {self.startup['model_load_ms']:.0f}ms, "
+                f"warm-up inference {self.startup['warm_up_ms']:.0f}ms, "
+                f"{self.startup['workers_warm']}/{self.workers} workers)."
+            )
+        except Exception as e:
+            logger.error(f"NSFW detector warm-up failed, scanning will load the model on demand: {e}")
         finally:
-            try:
-                os.unlink(temp_path)
-            except Exception as e:
-                logger.error(f"Error deleting temp file: {e}")
+            # Held attachments are released either way, a broken model fails each scan on its own
+            self.ready.set()
+
+    async def setup_indexes(self) -> None:
+        if self.hashes is not None:
+            await self.hashes.create_index("hash", unique=True)
+
+    async def load_hashes(self) -> int:
+        if self.hashes is None:
+            return 0
+        for doc in await self.hashes.find({}, {'_id': 0, 'hash': 1, 'score': 1, 'cleared': 1}):
+            value = int(doc['hash'], 16)
+            if doc.get('cleared'):
+                self.cleared.add(value)
+            elif doc.get('score', 0.0) >= self.hash_min_score and informative(value):
+                self.known_bad.add(value, doc['score'])
+        return len(self.known_bad)
+
+    async def _remember_bad(self, image_hash: int, score: float, source: Optional[Dict[str, Any]]) -> None:
+        self.known_bad.add(image_hash, score)
+        if self.hashes is None:
+            return
+        try:
+            await self.hashes.update_one(
+                {'hash': to_hex(image_hash)},
+                {'$setOnInsert': {'score': score, 'created_at': datetime.now(timezone.utc), **(source or {})}},
+                upsert=True
+            )
+        except Exception as e:
+            logger.error(f"Failed to persist NSFW hash {to_hex(image_hash)}: {e}")
 
-    async def check_image(self, image_url: str) -> Tuple[bool, float, str]:
+    async def forget_hash(self, hex_hash: str, cleared_by: Optional[int] = None) -> bool:
+        """Stop matching a stored hash and never store it again, returns False if it was not stored"""
         try:
-            async with self.session.get(image_url) as response:
-                if response.status != 200:
-                    logger.error(f"Failed to download image: {response.status}")
-                    return False, 0.0, "unknown"
+            image_hash = int(hex_hash, 16)
+        except ValueError:
+            return False
+
+        removed = self.known_bad.remove(image_hash)
+        self.cleared.add(image_hash)
+        if self.hashes is not None:
+            result = await self.hashes.update_one(
+                {'hash': to_hex(image_hash), 'cleared': {'$ne': True}},
+                {
+                    '$set': {'cleared': True, 'cleared_by': cleared_by, 'cleared_at': datetime.now(timezone.utc)},
+                    '$unset': {'score': ''}
+                }
+            )
+            removed = removed or result.modified_count > 0
+        if removed:
+            logger.info(f"NSFW hash {to_hex(image_hash)} cleared by {cleared_by}.")
+        return removed
 
-                image_data = await response.read()
+    async def classify(self, data: bytes, source: Optional[Dict[str, Any]] = None) -> Optional[ScanResult]:
+        """Verdict for an image, from the caches when these bytes or a stored near-duplicate were seen before, None if unscored"""
+        loop = asyncio.get_running_loop()
+        # Verdicts are cached by content, a dHash is public in every ref and easy to forge onto other pixels
+        digest = await loop.run_in_executor(None, content_digest, data)
+        cached = self.verdicts.get(digest)
+        if cached is not None:
+            image_hash = cached[2]
+        else:
+            prepared = await loop.run_in_executor(None, self.preprocessor.prepare, data)
+            if prepared is None:
+                # Too many pixels to decode safely, or not an image at all: unscanned, so it is not relayed either
+                return None
+            image_hash = prepared.hash
 
-                try:
-                    img = Image.open(io.BytesIO(image_data))
-                    img.verify()
-                except Exception as e:
-                    logger.error(f"Invalid image format: {e}")
-                    return False, 0.0, "invalid"
+        # Flat and plain gradient images share a handful of hashes, and a hash a moderator cleared is
+        # no longer matched or stored. Either way the model, or the cached verdict for these bytes, decides.
+        matchable = informative(image_hash) and image_hash not in self.cleared
+        if matchable:
+            match = self.known_bad.nearest(image_hash)
+            if match is not None:
+                self.known_bad_hits += 1
+                return ScanResult(True, match[1], 'image', to_hex(match[0]))
 
-                return False, 0.0, "safe"
+        if cached is not None:
+            return ScanResult(cached[0], cached[1], 'image')
 
+        try:
+            score = await self.batcher.submit(prepared.thumbnail)
         except Exception as e:
-            logger.error(f"Error checking image: {e}")
-            return False, 0.0, "error"
-
-    async def check_message(self, message: discord.Message) -> Tuple[bool, float, str]:
-        for attachment in message.attachments:
-            if attachment.content_type and attachment.content_type.startswith('image/'):
-                is_nsfw, score, content_type = await self.check_image(attachment.url)
-                if is_nsfw:
-                    return True, score, content_type
-        return False, 0.0, "safe"
-
-    def cleanup(self):
-        self.executor.shutdown(wait=True)
-
-        if not self.session.closed:
-            self.session.close()
+            # Not cached, a failed inference says nothing about the image
+            logger.error(f"Error analyzing image: {e}")
+            return None
+
+        is_nsfw = score >= self.NSFW_THRESHOLD
+        self.verdicts.put(digest, (is_nsfw, score, image_hash))
+        if matchable and score >= self.hash_min_score:
+            await self._remember_bad(image_hash, score, source)
+        return ScanResult(is_nsfw, score, 'image')
+
+    async def analyze_video(self, video: Union[bytes, str], suffix: str) -> Optional[Tuple[bool, float]]:
+        """Verdict for a video given as bytes or a file path, None if it could not be scored"""
+        try:
+            return await self.pool.run(
+                _scan_video,
+                video,
+                suffix,
+                self.NSFW_THRESHOLD,
+                self.VIDEO_NSFW_RATIO,
+                self.video_max_frames,
+                self.video_max_seconds,
+                self.batcher.max_batch
+            )
+        except Exception as e:
+            logger.error(f"Error analyzing video: {e}")
+            return None
+
+    async def check_image(self, attachment: SharedAttachment,
+                          source: Optional[Dict[str, Any]] = None) -> Optional[ScanResult]:
+        if attachment.spooled:
+            data = await asyncio.get_running_loop().run_in_executor(None, attachment.read)
+        else:
+            data = attachment.read()
+        return await self.classify(data, source)
+
+    async def check_video(self, attachment: SharedAttachment) -> Optional[ScanResult]:
+        # A spooled video is decoded straight from its file
+        suffix = os.path.splitext(attachment.filename)[1].lower() or '.mp4'
+        verdict = await self.analyze_video(attachment.path if attachment.spooled else attachment.read(), suffix)
+        if verdict is None:
+            return None
+        return ScanResult(verdict[0], verdict[1], 'video')
+
+    async def scan_message(self, message: discord.Message, attachments: AttachmentBundle) -> ScanResult:
+        return await self.check_attachments(attachments, scan_source(message))
+
+    async def check_attachments(self, attachments: AttachmentBundle,
+                                source: Optional[Dict[str, Any]] = None) -> ScanResult:
+        """Scan the already downloaded attachments of a message, listing the ones that could not be scanned"""
+        checks = []
+        positions = []
+        for index, attachment in enumerate(attachments.attachments):
+            kind = scan_kind(attachment.content_type, attachment.filename)
+            if kind == 'image':
+                checks.append(self.check_image(attachment, source))
+            elif kind == 'video':
+                checks.append(self.check_video(attachment))
+            else:
+                continue
+            positions.append(index)
+
+        # Every attachment of the message is scored at once, spread over the worker processes
+        results = await asyncio.gather(*checks)
+        merged = ScanResult.merge(result for result in results if result is not None)
+        merged.unscanned = [index for index, result in zip(positions, results) if result is None]
+        return merged
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.batcher.stats(),
+            **super().stats(),
+            'verdict_cache_size': len(self.verdicts),
+            'verdict_cache_hits': self.verdicts.hits,
+            'verdict_cache_misses': self.verdicts.misses,
+            'known_bad_hashes': len(self.known_bad),
+            'known_bad_hits': self.known_bad_hits,
+            'cleared_hashes': len(self.cleared),
+            'pool_rebuilds': self.pool.rebuilds
+        }
+
+    async def collect_stats(self) -> Dict[str, Any]:
+        return self.stats()
+
+    async def cleanup(self):
+        await self.batcher.close()
+        self.pool.shutdown()
@@ -0,0 +1,114 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Generic, Hashable, List, Optional, Tuple, TypeVar
+
+from PIL import Image
+
+HASH_BITS = 64
+# Fewer set (or unset) bits than this and the hash says too little about the image to match on
+MIN_HASH_BITS = 8
+
+V = TypeVar('V')
+
+
+def dhash_image(image: Image.Image, size: int = 8) -> int:
+    """64-bit difference hash of a decoded image"""
+    pixels = list(image.convert('L').resize((size + 1, size), Image.Resampling.LANCZOS).getdata())
+
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            value = (value << 1) | (pixels[offset + col] < pixels[offset + col + 1])
+    return value
+
+
+def informative(value: int) -> bool:
+    """False for flat, dark or plain gradient images, whose hashes all sit near 0 or near all-ones"""
+    return MIN_HASH_BITS <= value.bit_count() <= HASH_BITS - MIN_HASH_BITS
+
+
+def to_hex(value: int) -> str:
+    return f'{value:016x}'
+
+
+class HashIndex(Generic[V]):
+    """Multi-index hashing: hashes within max_distance bits of each other share at least one band exactly"""
+
+    def __init__(self, max_distance: int = 4):
+        self.max_distance = max(0, min(max_distance, HASH_BITS // 2 - 1))
+        self.bands = self.max_distance + 1
+        bounds = [HASH_BITS * band // self.bands for band in range(self.bands + 1)]
+        self._slices = [(start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])]
+        self._buckets: List[Dict[int, List[int]]] = [{} for _ in range(self.bands)]
+        self.values: Dict[int, V] = {}
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __contains__(self, value: int) -> bool:
+        return value in self.values
+
+    def add(self, value: int, payload: V) -> None:
+        if value not in self.values:
+            for buckets, (shift, mask) in zip(self._buckets, self._slices):
+                buckets.setdefault((value >> shift) & mask, []).append(value)
+        self.values[value] = payload
+
+    def remove(self, value: int) -> bool:
+        if value not in self.values:
+            return False
+        del self.values[value]
+        for buckets, (shift, mask) in zip(self._buckets, self._slices):
+            key = (value >> shift) & mask
+            bucket = buckets[key]
+            bucket.remove(value)
+            if not bucket:
+                del buckets[key]
+        return True
+
+    def nearest(self, value: int) -> Optional[Tuple[int, V, int]]:
+        """Closest stored hash within max_distance as (hash, payload, distance), or None"""
+        if value in self.values:
+            return value, self.values[value], 0
+
+        best: Optional[Tuple[int, int]] = None
+        for buckets, (shift, mask) in zip(self._buckets, self._slices):
+            for candidate in buckets.get((value >> shift) & mask, ()):
+                distance = (candidate ^ value).bit_count()
+                if distance <= self.max_distance and (best is None or distance < best[1]):
+                    best = candidate, distance
+        if best is None:
+            return None
+        return best[0], self.values[best[0]], best[1]
+
+
+class VerdictCache(Generic[V]):
+    """LRU of recent verdicts keyed by content digest, entries also expire after ttl seconds"""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[Hashable, Tuple[float, V]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[V]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: Hashable, verdict: V) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, verdict)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import sys
+import time
+from array import array
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class UserWindow:
+    """Ring of a user's most recent message timestamps, never longer than threshold + 1"""
+
+    __slots__ = ('times', 'head', 'count')
+
+    def __init__(self, capacity: int):
+        self.times = array('d', bytes(8 * capacity))
+        self.head = 0
+        self.count = 0
+
+    def newest(self) -> float:
+        return self.times[(self.head + self.count - 1) % len(self.times)]
+
+    def evict_outside(self, now: float, window: float) -> None:
+        capacity = len(self.times)
+        while self.count and now - self.times[self.head] > window:
+            self.head = (self.head + 1) % capacity
+            self.count -= 1
+
+    def push(self, timestamp: float) -> None:
+        capacity = len(self.times)
+        if self.count == capacity:
+            # Full ring, the oldest entry makes way; the count stays above the threshold either way
+            self.head = (self.head + 1) % capacity
+            self.count -= 1
+        self.times[(self.head + self.count) % capacity] = timestamp
+        self.count += 1
+
+
+class SpamLimiter:
+    """Per-user sliding window with the same threshold and cooldown rules as the original list-based check"""
+
+    def __init__(self, threshold: int, window: float, cooldown: float, sweep_interval: float = 60):
+        self.threshold = threshold
+        self.window = window
+        self.cooldown = cooldown
+        self.sweep_interval = sweep_interval
+        self.users: Dict[int, UserWindow] = {}
+        self.evicted = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def check(self, user_id: int, now: Optional[float] = None) -> Optional[str]:
+        """Record a message and return the rejection reason, or None if it may pass"""
+        now = time.monotonic() if now is None else now
+
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.users[user_id] = UserWindow(self.threshold + 1)
+
+        user.push(now)
+        user.evict_outside(now, self.window)
+
+        if user.count > self.threshold:
+            return "Too many messages sent in a short time"
+
+        if user.count > 1:
+            previous = user.times[(user.head + user.count - 2) % len(user.times)]
+            if now - previous < self.cooldown:
+                return "Message sent too quickly"
+
+        return None
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        """Drop users whose newest message has left the window, they would start from scratch anyway"""
+        now = time.monotonic() if now is None else now
+        idle = [
+            user_id for user_id, user in self.users.items()
+            if user.count == 0 or now - user.newest() > self.window
+        ]
+        for user_id in idle:
+            del self.users[user_id]
+        self.evicted += len(idle)
+        return len(idle)
+
+    def stats(self) -> Dict[str, int]:
+        live = len(self.users)
+        per_user = 0
+        if live:
+            sample = next(iter(self.users.values()))
+            per_user = sys.getsizeof(sample) + sys.getsizeof(sample.times)
+        return {
+            'live_users': live,
+            'evicted': self.evicted,
+            'approx_bytes': sys.getsizeof(self.users) + live * per_user
+        }
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            evicted = self.sweep()
+            if evicted:
+                logger.debug(f"Spam limiter evicted {evicted} idle users, {len(self.users)} live.")
+
+    async def stop(self) -> None:
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, List, Mapping, Optional
+
+import discord
+from discord import TextChannel
+from discord.ext import commands
+
+logger = logging.getLogger(__name__)
+
+
+class PooledWebhook:
+    def __init__(self, webhook: discord.Webhook):
+        self.webhook = webhook
+        self.sent: Deque[float] = deque()
+        self.blocked_until = 0.0
+
+    def remaining(self, limit: int, window: float, now: float) -> int:
+        if now < self.blocked_until:
+            return 0
+        while self.sent and now - self.sent[0] > window:
+            self.sent.popleft()
+        return limit - len(self.sent)
+
+
+class WebhookPool:
+    """The relay webhooks of one channel, picked by whichever has the most rate-limit budget left"""
+
+    def __init__(self, limit: int, window: float):
+        self.limit = limit
+        self.window = window
+        self.members: List[PooledWebhook] = []
+        self._cursor = 0
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+    def add(self, webhook: discord.Webhook) -> None:
+        if all(member.webhook.id != webhook.id for member in self.members):
+            self.members.append(PooledWebhook(webhook))
+
+    def remove(self, webhook_id: int) -> None:
+        self.members = [member for member in self.members if member.webhook.id != webhook_id]
+
+    def get(self, webhook_id: int) -> Optional[PooledWebhook]:
+        return discord.utils.find(lambda member: member.webhook.id == webhook_id, self.members)
+
+    def acquire(self) -> Optional[discord.Webhook]:
+        if not self.members:
+            return None
+
+        now = time.monotonic()
+        count = len(self.members)
+        # Start from a rotating offset so members with equal budget are used round-robin
+        best: Optional[PooledWebhook] = None
+        best_remaining = -1
+        for offset in range(count):
+            member = self.members[(self._cursor + offset) % count]
+            remaining = member.remaining(self.limit, self.window, now)
+            if remaining > best_remaining:
+                best, best_remaining = member, remaining
+
+        self._cursor = (self._cursor + 1) % count
+        best.sent.append(now)
+        return best.webhook
+
+    def to_documents(self) -> List[Dict[str, Any]]:
+        return [{'id': member.webhook.id, 'token': member.webhook.token} for member in self.members]
+
+
+class WebhookRegistry:
+    """Keeps a pool of relay webhooks per registered channel, persisted on the channel's `servers` document"""
+
+    def __init__(self, bot: commands.Bot, servers, name: str, pool_size: int = 3,
+                 rate_limit: int = 5, rate_window: float = 2.0, warm_up_concurrency: int = 10):
+        self.bot = bot
+        self.servers = servers
+        self.name = name
+        self.pool_size = max(1, pool_size)
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.warm_up_concurrency = max(1, warm_up_concurrency)
+        self.pools: Dict[int, WebhookPool] = {}
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._refills: Dict[int, asyncio.Task] = {}
+
+    def _pool(self, channel_id: int) -> WebhookPool:
+        pool = self.pools.get(channel_id)
+        if pool is None:
+            pool = self.pools[channel_id] = WebhookPool(self.rate_limit, self.rate_window)
+        return pool
+
+    def load(self, server: Mapping[str, Any]) -> int:
+        """Restore the webhooks stored on a `servers` document, returns how many were found"""
+        if 'channel_id' not in server:
+            return 0
+
+        stored = list(server.get('webhooks') or [])
+        if server.get('webhook'):
+            stored.append(server['webhook'])
+
+        channel_id = int(server['channel_id'])
+        loaded = 0
+        for entry in stored:
+            try:
+                self._pool(channel_id).add(discord.Webhook.partial(int(entry['id']), entry['token'], client=self.bot))
+                loaded += 1
+            except Exception as e:
+                logger.error(f"Invalid stored webhook for channel {channel_id}: {e}")
+        return loaded
+
+    async def acquire(self, channel: TextChannel) -> Optional[discord.Webhook]:
+        pool = self.pools.get(channel.id)
+        if not pool:
+            await self.reconcile(channel)
+            pool = self.pools.get(channel.id)
+            if not pool:
+                return None
+        elif len(pool) < self.pool_size:
+            self._schedule_refill(channel)
+        return pool.acquire()
+
+    def record_rate_limit(self, channel_id: int, webhook_id: int, retry_after: float) -> None:
+        pool = self.pools.get(channel_id)
+        member = pool.get(webhook_id) if pool else None
+        if member:
+            member.blocked_until = time.monotonic() + retry_after
+
+    def _schedule_refill(self, channel: TextChannel) -> None:
+        task = self._refills.get(channel.id)
+        if task is None or task.done():
+            self._refills[channel.id] = asyncio.create_task(self.reconcile(channel))
+
+    async def reconcile(self, channel: TextChannel) -> None:
+        """Match the pool against the channel's actual webhooks, adopting ours and creating any that are missing"""
+        lock = self._locks.setdefault(channel.id, asyncio.Lock())
+        async with lock:
+            try:
+                existing = [
+                    webhook for webhook in await channel.webhooks()
+                    if webhook.name == self.name and webhook.token is not None
+                ]
+
+                pool = WebhookPool(self.rate_limit, self.rate_window)
+                previous = self.pools.get(channel.id)
+                for webhook in existing[:self.pool_size]:
+                    member = previous.get(webhook.id) if previous else None
+                    if member:
+                        pool.members.append(member)
+                    else:
+                        pool.add(webhook)
+
+                while len(pool) < self.pool_size:
+                    pool.add(await channel.create_webhook(name=self.name))
+                    logger.info(f"Created new webhook for channel {channel.id}.")
+
+                if len(existing) > self.pool_size:
+                    logger.warning(
+                        f"Channel {channel.id} has {len(existing)} relay webhooks, "
+                        f"only {self.pool_size} are pooled."
+                    )
+
+                self.pools[channel.id] = pool
+            except discord.Forbidden:
+                logger.error(f"Missing permissions to manage webhooks in channel {channel.id}.")
+                return
+            except Exception as e:
+                logger.error(f"Error reconciling webhooks in channel {channel.id}: {e}")
+                return
+
+        await self._persist(channel.id)
+
+    async def _persist(self, channel_id: int) -> None:
+        pool = self.pools.get(channel_id)
+        try:
+            await self.servers.update_one(
+                {'channel_id': channel_id},
+                {
+                    '$set': {'webhooks': pool.to_documents() if pool else []},
+                    '$unset': {'webhook': ''}
+                }
+            )
+        except Exception as e:
+            logger.error(f"Failed to store webhooks for channel {channel_id}: {e}")
+
+    async def invalidate(self, channel_id: int, webhook_id: int) -> None:
+        """Forget a webhook that Discord no longer knows about, the rest of the pool keeps serving"""
+        pool = self.pools.get(channel_id)
+        if pool:
+            pool.remove(webhook_id)
+        await self._persist(channel_id)
+        logger.info(f"Invalidated webhook {webhook_id} for channel {channel_id}.")
+
+    async def warm_up(self, channel_ids: Iterable[int]) -> None:
+        """Reconcile every registered channel's pool in the background once the bot is ready"""
+        channel_ids = list(channel_ids)
+        await self.bot.wait_until_ready()
+        semaphore = asyncio.Semaphore(self.warm_up_concurrency)
+
+        async def warm(channel_id: int) -> None:
+            channel = self.bot.get_channel(channel_id)
+            if not isinstance(channel, TextChannel):
+                return
+            async with semaphore:
+                await self.reconcile(channel)
+
+        await asyncio.gather(*(warm(channel_id) for channel_id in channel_ids))
+        logger.info(f"Webhook warm-up finished, {sum(len(pool) for pool in self.pools.values())} webhooks pooled.")
@@ -9,6 +9,7 @@ from pathlib import Path
 from typing import List, Union
 from dotenv import load_dotenv
 from events.cogs import CogManager
+from events.database import Database, DatabaseConfig
 
 BASE_DIR = Path(__file__).resolve().parent
 load_dotenv(BASE_DIR / '.env')
@@ -48,6 +49,7 @@ class Bot(commands.Bot):
         self.console_channel_id = int(os.getenv('CONSOLE_CHANNEL_ID', '0'))
         
         self.setup_logging()
+        self.database = Database(DatabaseConfig())
         self.cog_manager = CogManager(self)
 
     def setup_logging(self):
@@ -88,6 +90,9 @@ class Bot(commands.Bot):
                 setup_console_logging(self, self.console_channel_id)
                 self.logger.info("Console logging setup completed")
 
+            await self.database.ping()
+            self.logger.info("Connected to MongoDB successfully.")
+
             await self.cog_manager.load_cogs()
             await self.tree.sync()
             self.logger.info("Application commands synced")
@@ -158,6 +163,11 @@ class Bot(commands.Bot):
         
         await super().close()
 
+        try:
+            await self.database.close()
+        except Exception as e:
+            self.logger.error(f"Error closing MongoDB connection: {e}")
+
 async def main():
     TOKEN = os.getenv('TOKEN')
     if not TOKEN:
@@ -0,0 +1,10 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# The cogs read these at import time, nothing here ever connects
+os.environ.setdefault('MONGODB_URI', 'mongodb://127.0.0.1:1/?serverSelectionTimeoutMS=100')
+os.environ.setdefault('AUTHORIZED_USERS', '0')
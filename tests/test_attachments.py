@@ -0,0 +1,56 @@
+import gc
+import os
+
+import pytest
+
+from events.attachments import AttachmentFetcher, SharedAttachment
+from events.nsfw import ImagePreprocessor
+from test_nsfw_hashes import photo
+
+
+def test_spooled_attachment_files_close_their_handles(tmp_path):
+    path = tmp_path / 'clip.mp4'
+    path.write_bytes(b'x' * 1024)
+    shared = SharedAttachment('clip.mp4', False, None, path=str(path))
+
+    gc.disable()
+    try:
+        before = len(os.listdir('/proc/self/fd'))
+        for _ in range(100):
+            # What discord.py does with every file once a send finishes
+            shared.to_file().close()
+        assert len(os.listdir('/proc/self/fd')) == before
+    finally:
+        gc.enable()
+
+
+def test_images_under_the_budget_are_not_read_for_shrinking(tmp_path, monkeypatch):
+    path = tmp_path / 'photo.png'
+    path.write_bytes(photo(1))
+    shared = SharedAttachment('photo.png', False, None, path=str(path), content_type='image/png')
+    monkeypatch.setattr(SharedAttachment, 'read', lambda self: pytest.fail("read the whole file"))
+
+    for budget in (0, 10 * 1024 * 1024):
+        AttachmentFetcher._shrink(shared, ImagePreprocessor(forward_budget=budget).shrink_for_forwarding)
+        assert shared.path == str(path)
+
+
+def test_spooled_images_over_the_budget_are_shrunk_from_their_file(tmp_path):
+    path = tmp_path / 'photo.png'
+    path.write_bytes(photo(1, (1600, 1200)))
+    shared = SharedAttachment('photo.png', False, None, path=str(path), content_type='image/png')
+    preprocessor = ImagePreprocessor(forward_budget=1024, forward_max_side=200)
+
+    AttachmentFetcher._shrink(shared, preprocessor.shrink_for_forwarding)
+    assert not shared.spooled and shared.filename == 'photo.jpg'
+    assert preprocessor.forward_shrunk == 1
+
+
+def test_forwarding_does_not_count_towards_scan_statistics():
+    preprocessor = ImagePreprocessor(max_pixels=320 * 240, forward_budget=1)
+    assert preprocessor.shrink_for_forwarding(b'not an image', 12, 'broken.png') is None
+    assert preprocessor.shrink_for_forwarding(photo(2, (640, 480)), 10 ** 6, 'huge.png') is None
+
+    stats = preprocessor.stats()
+    assert (stats['forward_undecodable'], stats['forward_oversized']) == (1, 1)
+    assert (stats['undecodable'], stats['oversized']) == (0, 0)
@@ -0,0 +1,141 @@
+import asyncio
+
+from pymongo.errors import AutoReconnect, OperationFailure
+
+from events.bans import CHANGE_STREAM_HISTORY_LOST, BanIndex
+
+
+def ban(doc_id, user_id, active=True):
+    return {'_id': doc_id, 'user_id': user_id, 'active': active}
+
+
+def test_remove_lifts_every_active_document_of_a_user():
+    index = BanIndex(None)
+    index.apply(ban(1, 7))
+    index.apply(ban(2, 7))
+    index.apply(ban(3, 8))
+
+    index.remove(user_id=7)
+    assert not index.is_banned(user_id=7)
+    assert index.is_banned(user_id=8)
+
+    # The change stream then reports both documents as lifted, which must not bring anything back
+    index.apply(ban(1, 7, active=False))
+    index.apply(ban(2, 7, active=False))
+    assert not index.is_banned(user_id=7)
+    assert index.is_banned(user_id=8)
+
+
+def test_user_stays_banned_while_another_document_is_active():
+    index = BanIndex(None)
+    index.apply(ban(1, 7))
+    index.apply(ban(2, 7))
+
+    index.apply(ban(1, 7, active=False))
+    assert index.is_banned(user_id=7)
+
+    index._forget(2)
+    assert not index.is_banned(user_id=7)
+
+
+def test_new_ban_after_remove_is_tracked():
+    index = BanIndex(None)
+    index.apply(ban(1, 7))
+    index.remove(user_id=7)
+
+    index.apply(ban(2, 7))
+    assert index.is_banned(user_id=7)
+    index.apply(ban(2, 7, active=False))
+    assert not index.is_banned(user_id=7)
+
+
+class FakeStream:
+    def __init__(self, changes):
+        self.changes = list(changes)
+        self.resume_token = None
+
+    async def try_next(self):
+        if not self.changes:
+            await asyncio.sleep(0.01)
+            return None
+        change = self.changes.pop(0)
+        if isinstance(change, Exception):
+            raise change
+        self.resume_token = {'_data': change['documentKey']['_id']}
+        return change
+
+    async def close(self):
+        pass
+
+
+class FakeBans:
+    """Collection whose change streams replay scripted changes, each watch() call takes the next script"""
+
+    def __init__(self, docs, streams):
+        self.docs = docs
+        self.streams = list(streams)
+        self.watches = []
+        self.loads = 0
+
+    async def operation_time(self):
+        self.loads += 1
+        return f"t{self.loads}"
+
+    async def find(self, *args, **kwargs):
+        return list(self.docs)
+
+    async def watch(self, **options):
+        self.watches.append(options)
+        if not self.streams:
+            return FakeStream([])
+        script = self.streams.pop(0)
+        if isinstance(script, Exception):
+            raise script
+        return FakeStream(script)
+
+
+def change(doc):
+    return {'operationType': 'update', 'documentKey': {'_id': doc['_id']}, 'fullDocument': doc}
+
+
+def run_index(bans, until):
+    async def main():
+        index = BanIndex(bans, retry_delay=0.01)
+        await index.load()
+        index.start()
+        for _ in range(200):
+            if until(index):
+                break
+            await asyncio.sleep(0.01)
+        await index.stop()
+        return index
+
+    return asyncio.run(main())
+
+
+def test_stream_starts_at_load_time_and_resumes_after_errors():
+    bans = FakeBans([ban(1, 7)], [
+        [change(ban(2, 8)), AutoReconnect("connection reset")],
+        AutoReconnect("primary stepped down"),
+        [change(ban(1, 7, active=False))]
+    ])
+    index = run_index(bans, lambda index: not index.is_banned(user_id=7))
+
+    assert index.is_banned(user_id=8) and not index.is_banned(user_id=7)
+    assert bans.watches[0]['start_at_operation_time'] == 't1'
+    # Every reopen continues after the last change seen instead of switching to polling
+    assert [options.get('resume_after') for options in bans.watches[1:3]] == [{'_data': 2}, {'_data': 2}]
+
+
+def test_stream_that_cannot_resume_reloads():
+    bans = FakeBans([ban(1, 7)], [
+        [change(ban(2, 8)), OperationFailure("history lost", CHANGE_STREAM_HISTORY_LOST)],
+        []
+    ])
+    index = run_index(bans, lambda index: len(bans.watches) == 2)
+
+    assert bans.loads == 2
+    assert bans.watches[1] == {'full_document': 'updateLookup', 'max_await_time_ms': 1000,
+                               'start_at_operation_time': 't2'}
+    # The reload replaces the index with what the collection holds
+    assert index.is_banned(user_id=7) and not index.is_banned(user_id=8)
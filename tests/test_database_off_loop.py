@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+import pytest
+from bson.timestamp import Timestamp
+from pymongo import database as pymongo_database
+from pymongo.collection import Collection
+
+from events.bans import BanIndex
+from events.database import Database, DatabaseConfig
+from events.message_log import MessageLogBuffer
+from events.mutes import MuteEntry, MuteStore
+
+# Every pymongo call the data-access layer makes, each with the value a real server could answer
+COLLECTION_METHODS = {
+    'find_one': lambda *args, **kwargs: {'_id': 1, 'count': 1},
+    'find': lambda *args, **kwargs: iter([{'_id': 1, 'user_id': 7, 'active': True, 'channel_id': 42}]),
+    'count_documents': lambda *args, **kwargs: 1,
+    'insert_one': lambda *args, **kwargs: None,
+    'insert_many': lambda *args, **kwargs: None,
+    'update_one': lambda *args, **kwargs: None,
+    'update_many': lambda *args, **kwargs: None,
+    'delete_one': lambda *args, **kwargs: None,
+    'delete_many': lambda *args, **kwargs: None,
+    'find_one_and_update': lambda *args, **kwargs: {'_id': 'report_count', 'count': 3},
+    'find_one_and_delete': lambda *args, **kwargs: None,
+    'bulk_write': lambda *args, **kwargs: None,
+    'create_index': lambda *args, **kwargs: 'index',
+    'watch': lambda *args, **kwargs: FakeChangeStream()
+}
+
+# Long enough that debug mode reports it if it ever runs inside a callback on the loop
+FAKE_IO_SECONDS = 0.05
+
+
+class FakeChangeStream:
+    resume_token = None
+
+    def try_next(self):
+        record_call('try_next')
+        return None
+
+    def close(self):
+        record_call('close')
+
+
+calls = []
+
+
+def record_call(name):
+    calls.append((name, threading.get_ident()))
+    time.sleep(FAKE_IO_SECONDS)
+
+
+@pytest.fixture
+def database(monkeypatch):
+    calls.clear()
+    for name, result in COLLECTION_METHODS.items():
+        def fake(self, *args, _name=name, _result=result, **kwargs):
+            record_call(_name)
+            return _result(*args, **kwargs)
+        monkeypatch.setattr(Collection, name, fake)
+
+    def command(self, *args, **kwargs):
+        record_call('command')
+        return {'ok': 1, 'operationTime': Timestamp(1, 1)}
+    monkeypatch.setattr(pymongo_database.Database, 'command', command)
+
+    database = Database(DatabaseConfig())
+    yield database
+    database.client.close()
+    database.executor.shutdown(wait=True)
+
+
+def run_off_loop_check(coro_factory, caplog):
+    """Run the coroutine in debug mode, failing on any pymongo call or slow callback on the loop thread"""
+    loop_thread = []
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        loop.slow_callback_duration = FAKE_IO_SECONDS / 2
+        loop_thread.append(threading.get_ident())
+        await coro_factory()
+
+    with caplog.at_level(logging.WARNING, logger='asyncio'):
+        asyncio.run(main(), debug=True)
+
+    assert calls, "nothing reached pymongo"
+    on_loop = [name for name, thread in calls if thread == loop_thread[0]]
+    assert not on_loop, f"pymongo called on the event loop thread: {on_loop}"
+    slow = [record.getMessage() for record in caplog.records if 'Executing' in record.getMessage()]
+    assert not slow, f"blocking callbacks on the event loop: {slow}"
+
+
+def test_async_collection_runs_every_call_off_the_loop(database, caplog):
+    async def exercise():
+        collection = database['things']
+        await collection.find_one({})
+        assert await collection.find({}) == [{'_id': 1, 'user_id': 7, 'active': True, 'channel_id': 42}]
+        await collection.count_documents({})
+        await collection.insert_one({})
+        await collection.insert_many([{}])
+        await collection.update_one({}, {'$set': {}})
+        await collection.update_many({}, {'$set': {}})
+        await collection.delete_one({})
+        await collection.delete_many({})
+        await collection.find_one_and_update({}, {'$inc': {'count': 1}})
+        await collection.find_one_and_delete({})
+        await collection.bulk_write([])
+        await collection.create_index('field')
+        assert await collection.operation_time() == Timestamp(1, 1)
+        stream = await collection.watch()
+        await stream.try_next()
+        await stream.close()
+
+    run_off_loop_check(exercise, caplog)
+    assert {name for name, _ in calls} == set(COLLECTION_METHODS) | {'command', 'try_next', 'close'}
+
+
+def test_buffers_and_indexes_write_off_the_loop(database, caplog):
+    async def exercise():
+        log = MessageLogBuffer(database['message_logs'], batch_size=2)
+        for index in range(5):
+            log.add({'n': index})
+        await log.flush()
+        assert log.written == 5
+
+        mutes = MuteStore(database['mutes'])
+        await mutes.setup_indexes()
+        mutes.save(MuteEntry(7, None, "reason", None, 42, 0))
+        mutes.delete(8)
+        await mutes.flush()
+        assert await mutes.load()
+
+        bans = BanIndex(database['bans'])
+        await bans.load()
+        assert bans.is_banned(user_id=7)
+
+    run_off_loop_check(exercise, caplog)
+
+
+def test_cog_database_paths_run_off_the_loop(database, caplog):
+    from cogs.banglobal import BeaniverseBanSystem
+    from cogs.handler import GlobalChatHandler
+
+    class Bot:
+        def __init__(self, loop):
+            self.database = database
+            self.loop = loop
+
+        def get_channel(self, channel_id):
+            return None
+
+        async def wait_until_ready(self):
+            return None
+
+    async def exercise():
+        bot = Bot(asyncio.get_running_loop())
+        handler = GlobalChatHandler(bot)
+        await handler.setup_indexes()
+        await handler.setup_report_indexes()
+        await handler.load_registered_channels()
+        assert handler.registered_channels == {42}
+        assert await handler.store_report({'report_number': 1, 'timestamp': datetime.now(timezone.utc)})
+        assert await handler.get_next_report_number() == 3
+        await handler.cleanup()
+
+        ban_system = BeaniverseBanSystem(bot)
+        await ban_system.setup_indexes()
+        await ban_system.index.load()
+        assert ban_system.is_banned(user_id=7)
+
+    run_off_loop_check(exercise, caplog)
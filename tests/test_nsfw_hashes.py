@@ -0,0 +1,112 @@
+import asyncio
+import io
+import random
+
+from PIL import Image, ImageDraw
+
+from events.nsfw import NSFWDetector
+
+
+def photo(seed, size=(320, 240)):
+    rng = random.Random(seed)
+    image = Image.new('RGB', size, (128, 128, 128))
+    draw = ImageDraw.Draw(image)
+    for _ in range(30):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        draw.rectangle((x, y, x + rng.randrange(20, 120), y + rng.randrange(20, 90)),
+                       fill=tuple(rng.randrange(256) for _ in range(3)))
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def flat(shade=10):
+    buffer = io.BytesIO()
+    Image.new('RGB', (320, 240), (shade, shade, shade)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def reencoded(data, format='BMP'):
+    """Same pixels, so the same dHash, in different bytes"""
+    buffer = io.BytesIO()
+    Image.open(io.BytesIO(data)).save(buffer, format=format)
+    return buffer.getvalue()
+
+
+def run_with_scores(scores, scenario):
+    """Run scenario(detector) with the model replaced by a queue of scores, returns how many it consumed"""
+    async def main():
+        detector = NSFWDetector(workers=1, hash_min_score=0.9)
+        queue = list(scores)
+
+        async def submit(thumbnail):
+            return queue.pop(0)
+
+        detector.batcher.submit = submit
+        try:
+            await scenario(detector)
+        finally:
+            await detector.cleanup()
+        return len(scores) - len(queue)
+
+    return asyncio.run(main())
+
+
+def test_only_confident_verdicts_are_stored():
+    async def scenario(detector):
+        result = await detector.classify(photo(1))
+        assert result.is_nsfw and result.known_hash is None
+        assert len(detector.known_bad) == 0
+
+        result = await detector.classify(photo(2))
+        assert result.is_nsfw and result.known_hash is None
+        assert len(detector.known_bad) == 1
+
+        # The repost is matched by hash, without asking the model again
+        repost = await detector.classify(photo(2))
+        assert repost.is_nsfw and repost.known_hash is not None
+
+    assert run_with_scores([0.8, 0.95], scenario) == 2
+
+
+def test_flat_images_are_never_stored_or_matched():
+    async def scenario(detector):
+        result = await detector.classify(flat(10))
+        assert result.is_nsfw
+        assert len(detector.known_bad) == 0
+
+        # Another flat image shares the dHash but is judged on its own
+        other = await detector.classify(flat(200))
+        assert not other.is_nsfw
+
+    assert run_with_scores([0.99, 0.1], scenario) == 2
+
+
+def test_safe_verdicts_are_not_shared_by_a_forged_hash():
+    async def scenario(detector):
+        safe = await detector.classify(photo(4))
+        assert not safe.is_nsfw
+
+        # The same bytes come from the cache, different bytes with the same dHash go to the model
+        assert not (await detector.classify(photo(4))).is_nsfw
+        forged = await detector.classify(reencoded(photo(4)))
+        assert forged.is_nsfw and forged.known_hash is None
+
+    assert run_with_scores([0.1, 0.8], scenario) == 2
+
+
+def test_forgotten_hash_is_scored_but_not_matched_or_stored_again():
+    async def scenario(detector):
+        first = await detector.classify(photo(3))
+        known = await detector.classify(reencoded(photo(3)))
+        assert first.is_nsfw and known.known_hash is not None
+        assert await detector.forget_hash(known.known_hash)
+        assert not await detector.forget_hash(known.known_hash)
+        assert not await detector.forget_hash("not a hash")
+
+        # A cleared hash is no reason to skip the model, it is just not matched or stored any more
+        rescored = await detector.classify(reencoded(photo(3), 'TIFF'))
+        assert not rescored.is_nsfw and rescored.known_hash is None
+        assert len(detector.known_bad) == 0
+
+    assert run_with_scores([0.97, 0.2], scenario) == 2
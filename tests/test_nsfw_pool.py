@@ -0,0 +1,35 @@
+import asyncio
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from events.nsfw import WorkerPool
+
+
+def worker_pid():
+    return os.getpid()
+
+
+def crash():
+    os._exit(1)
+
+
+def test_pool_is_rebuilt_after_a_worker_dies():
+    async def main():
+        pool = WorkerPool(1)
+        try:
+            first = await pool.run(worker_pid)
+
+            # The job kills its worker on the new pool too, so it fails on its own
+            with pytest.raises(BrokenProcessPool):
+                await pool.run(crash)
+            assert pool.rebuilds == 1
+
+            # Every later job gets a working pool again
+            assert await pool.run(worker_pid) != first
+            assert pool.rebuilds == 2
+        finally:
+            pool.shutdown()
+
+    asyncio.run(main())
@@ -0,0 +1,89 @@
+import asyncio
+
+from events.attachments import AttachmentBundle, SharedAttachment
+from events.moderation_worker import RemoteNSFWDetector
+from events.nsfw import NSFWDetector, ScanResult
+from test_nsfw_hashes import photo
+
+
+def shared(filename, content_type, data):
+    return SharedAttachment(filename, False, None, data=data, content_type=content_type)
+
+
+def test_attachments_that_cannot_be_scanned_are_listed():
+    async def main():
+        detector = NSFWDetector(workers=1)
+
+        async def submit(thumbnail):
+            raise RuntimeError("worker died")
+
+        async def analyze_video(video, suffix):
+            return False, 0.1
+
+        bundle = AttachmentBundle([
+            shared('notes.txt', 'text/plain', b'hello'),
+            shared('photo.png', 'image/png', photo(1)),
+            shared('clip.mp4', 'video/mp4', b'frames')
+        ])
+        detector.batcher.submit = submit
+        detector.analyze_video = analyze_video
+        try:
+            result = await detector.check_attachments(bundle)
+        finally:
+            await detector.cleanup()
+
+        assert not result.is_nsfw
+        assert result.unscanned == [1]
+        assert bundle.drop(result.unscanned) == ['photo.png']
+        assert [attachment.filename for attachment in bundle.attachments] == ['notes.txt', 'clip.mp4']
+
+    asyncio.run(main())
+
+
+def test_oversized_and_undecodable_images_are_not_scanned():
+    async def main():
+        detector = NSFWDetector(workers=1)
+        detector.preprocessor.max_pixels = 320 * 240
+
+        async def submit(thumbnail):
+            return 0.1
+
+        bundle = AttachmentBundle([
+            shared('small.png', 'image/png', photo(1)),
+            shared('huge.png', 'image/png', photo(2, (640, 480))),
+            shared('broken.png', 'image/png', b'not an image')
+        ])
+        detector.batcher.submit = submit
+        try:
+            result = await detector.check_attachments(bundle)
+        finally:
+            await detector.cleanup()
+
+        assert not result.is_nsfw
+        assert result.unscanned == [1, 2]
+
+    asyncio.run(main())
+
+
+def test_both_backends_share_the_unready_gate():
+    async def main():
+        for detector in (NSFWDetector(workers=1, unready_policy='allow'), RemoteNSFWDetector(unready_policy='allow')):
+            scanned = []
+
+            async def scan_message(message, attachments):
+                scanned.append(message)
+                return ScanResult(True, 0.9, 'image')
+
+            detector.scan_message = scan_message
+            try:
+                bundle = AttachmentBundle([shared('photo.png', 'image/png', photo(1))])
+                assert not (await detector.check_message('before', bundle)).is_nsfw
+                detector.ready.set()
+                assert (await detector.check_message('after', bundle)).is_nsfw
+            finally:
+                await detector.cleanup()
+
+            assert scanned == ['after']
+            assert detector.stats()['skipped_unready'] == 1
+
+    asyncio.run(main())
@@ -0,0 +1,40 @@
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from events import nsfw
+
+
+class SlowExplicitDetector:
+    """Flags every frame, slower per batch than the whole time budget"""
+
+    def __init__(self, seconds_per_batch):
+        self.seconds_per_batch = seconds_per_batch
+
+    def detect_batch(self, frames, batch_size):
+        time.sleep(self.seconds_per_batch)
+        return [[{'class': 'FEMALE_BREAST_EXPOSED', 'score': 0.95}] for _ in frames]
+
+
+@pytest.fixture
+def video(tmp_path):
+    path = str(tmp_path / 'clip.avi')
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 10, (64, 48))
+    for index in range(600):
+        writer.write(np.full((48, 64, 3), index % 256, np.uint8))
+    writer.release()
+    return path
+
+
+def test_video_past_its_time_budget_is_not_scored_safe(video, monkeypatch):
+    monkeypatch.setattr(nsfw, '_detector', SlowExplicitDetector(0.6))
+    with pytest.raises(TimeoutError):
+        nsfw._scan_video_file(video, threshold=0.7, ratio=0.3, max_frames=32, max_seconds=0.5, batch_size=8)
+
+
+def test_video_within_its_time_budget_is_scored(video, monkeypatch):
+    monkeypatch.setattr(nsfw, '_detector', SlowExplicitDetector(0))
+    is_nsfw, ratio = nsfw._scan_video_file(video, threshold=0.7, ratio=0.3, max_frames=32, max_seconds=5, batch_size=8)
+    assert is_nsfw and ratio >= 0.3
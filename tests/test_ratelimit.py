@@ -0,0 +1,85 @@
+import random
+
+import pytest
+
+from events.ratelimit import SpamLimiter
+
+
+class ListSpamCheck:
+    """The list-based check SpamLimiter replaced, kept verbatim as the reference"""
+
+    def __init__(self, threshold, window, cooldown):
+        self.SPAM_THRESHOLD = threshold
+        self.SPAM_TIME_WINDOW = window
+        self.SPAM_COOLDOWN = cooldown
+        self.user_message_count = {}
+
+    def check(self, user_id, current_time):
+        if user_id not in self.user_message_count:
+            self.user_message_count[user_id] = []
+
+        self.user_message_count[user_id].append(current_time)
+        self.user_message_count[user_id] = [
+            t for t in self.user_message_count[user_id]
+            if current_time - t <= self.SPAM_TIME_WINDOW
+        ]
+
+        if len(self.user_message_count[user_id]) > self.SPAM_THRESHOLD:
+            return "Too many messages sent in a short time"
+
+        if len(self.user_message_count[user_id]) > 1:
+            time_diff = current_time - self.user_message_count[user_id][-2]
+            if time_diff < self.SPAM_COOLDOWN:
+                return "Message sent too quickly"
+
+        return None
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_matches_the_list_based_check(seed):
+    rng = random.Random(seed)
+    # Quarter-second steps are exact in binary, so messages land right on the window and cooldown edges
+    threshold = rng.randint(1, 10)
+    window = rng.choice([0.25, 0.5, 1, 2, 5])
+    cooldown = rng.choice([0, 0.25, 0.5, 1, 2])
+
+    old = ListSpamCheck(threshold, window, cooldown)
+    new = SpamLimiter(threshold, window, cooldown)
+
+    now = 1000.0
+    for step in range(300):
+        now += rng.choice([0, 0, 0.25, 0.25, 0.5, 1, rng.randint(0, 40) * 0.25])
+        user_id = rng.randint(1, 4)
+        assert new.check(user_id, now) == old.check(user_id, now), (
+            f"seed {seed}, message {step}: threshold={threshold} window={window} cooldown={cooldown}"
+        )
+        if rng.random() < 0.05:
+            # Sweeping at any point must not change a later verdict
+            new.sweep(now)
+
+
+def test_sweep_evicts_only_users_past_the_window():
+    limiter = SpamLimiter(threshold=8, window=1, cooldown=2)
+    limiter.check(1, now=100.0)
+    limiter.check(2, now=100.5)
+    limiter.check(3, now=101.0)
+
+    assert limiter.sweep(now=101.25) == 1
+    assert set(limiter.users) == {2, 3}
+    assert limiter.sweep(now=102.0) == 1
+    assert set(limiter.users) == {3}
+
+    stats = limiter.stats()
+    assert stats['live_users'] == 1
+    assert stats['evicted'] == 2
+
+
+def test_window_memory_is_bounded_by_the_threshold():
+    limiter = SpamLimiter(threshold=3, window=60, cooldown=0)
+    for index in range(1000):
+        limiter.check(1, now=float(index) / 100)
+
+    user = limiter.users[1]
+    assert len(user.times) == 4
+    assert user.count == 4
+    assert limiter.check(1, now=10.0) == "Too many messages sent in a short time"